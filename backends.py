@@ -0,0 +1,120 @@
+import time
+from array import array
+
+# Default size of the fake device write record
+RECORD_SIZE = 65536
+
+
+class vjoybackend:
+    """Controller backend writing to a real vJoy device through pyvjoy"""
+
+    def __init__(self, device = 1):
+        import pyvjoy
+        self.joy = pyvjoy.VJoyDevice(device)
+
+
+    def write(self, buttons):
+        """Set the button bitmask and update the device"""
+
+        self.joy.data.lButtons = buttons
+        self.joy.update()
+
+
+class fakebackend:
+    """In-process vJoy stand-in. Every lButtons write is timestamped into
+    a preallocated ring buffer, so presses and timing can be measured without
+    Windows or vJoy installed.
+    """
+
+    def __init__(self, device = 1, size = RECORD_SIZE):
+        self.device = device
+        self.size = size
+        self.times = array("d", bytes(8 * size))
+        self.values = array("Q", bytes(8 * size))
+        self.count = 0
+        self.buttons = 0
+        # Tags of pressed commands, with the write count and time of the press
+        self.marks = []
+
+
+    def mark(self, tag):
+        """Record that the tagged command is pressed now, its button bit shows
+        up in the following writes unless the button was already held
+        """
+
+        self.marks.append((tag, self.count, time.monotonic()))
+
+
+    def write(self, buttons):
+        """Record the button bitmask with current time.monotonic() timestamp"""
+
+        idx = self.count % self.size
+        self.times[idx] = time.monotonic()
+        self.values[idx] = buttons
+        self.buttons = buttons
+        self.count += 1
+
+
+    def records(self):
+        """Return recorded (timestamp, buttons) pairs, oldest first"""
+
+        count = self.count
+        if count <= self.size:
+            return list(zip(self.times[:count], self.values[:count]))
+        start = count % self.size
+        times = self.times[start:] + self.times[:start]
+        values = self.values[start:] + self.values[:start]
+        return list(zip(times, values))
+
+
+    def clear(self):
+        self.count = 0
+        self.marks = []
+
+
+    def presses(self):
+        """Return list of (button, press time, hold time) for completed presses"""
+
+        result = []
+        pressed = {}
+        previous = 0
+        for timestamp, buttons in self.records():
+            changed = buttons ^ previous
+            while changed:
+                bit = changed & -changed
+                idx = bit.bit_length() - 1
+                if buttons & bit:
+                    pressed[idx] = timestamp
+                elif idx in pressed:
+                    start = pressed.pop(idx)
+                    result.append((idx, start, timestamp - start))
+                changed ^= bit
+            previous = buttons
+        return result
+
+
+    def stats(self):
+        """Return write count, update rate (writes/s) and press count"""
+
+        records = self.records()
+        if len(records) < 2:
+            return self.count, 0.0, 0
+        span = records[-1][0] - records[0][0]
+        rate = (len(records) - 1) / span if span > 0 else 0.0
+        return self.count, rate, len(self.presses())
+
+
+BACKENDS = {
+    "vjoy": vjoybackend,
+    "fake": fakebackend,
+}
+
+
+def create_backend(name, device = 1, **kwargs):
+    """Create controller backend by name"""
+
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise KeyError(f"Unknown controller backend: {name}")
+    return backend(device, **kwargs)
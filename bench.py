@@ -0,0 +1,408 @@
+"""Chat replay load generator and latency benchmark for CanalBot.
+
+Drives CanalBot.event_message with synthetic or recorded chat through fake
+context/channel objects, without connecting to Twitch. The controller uses
+the fake backend. Every command the bot executes is tagged with a sequence
+number that the fake backend records when the command is pressed, so each
+latency runs from the command passing the rate limit to the device write
+of exactly that command.
+
+Usage:
+    python bench.py [--scenario anarchy democracy communism live modes]
+                    [--messages 20000] [--users 5000] [--rate 1000] [--replay chat.txt]
+                    [--engine thread|asyncio] [--output results.json]
+                    [--compare previous.json]
+
+Recorded chat for --replay is one "user<TAB>message" per line, or an
+event log written by the bot ("event_log_file"), replayed in recorded order.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import canalbot
+import cmdparser
+import eventlog
+
+SCENARIOS = ("anarchy", "democracy", "communism", "live", "modes")
+
+# Share of messages that are mode votes, the modes scenario sends more
+MODE_VOTE_RATIO = 0.05
+MODES_VOTE_RATIO = 0.2
+
+# Live democracy chat follows the crowd: this share of the command votes go
+# to the crowd's current command, which changes every CROWD_MESSAGES messages
+CROWD_SHARE = 0.9
+CROWD_MESSAGES = 500
+
+# Lower is better for these, higher for messages per second
+REGRESSION_KEYS = {
+    "msgs_per_sec": 1,
+    "latency_p50_ms": -1,
+    "latency_p99_ms": -1,
+    "latency_p999_ms": -1,
+    "round_close_ms": -1,
+    "memory_growth_kib": -1,
+}
+
+CHATTER = ("lol", "what is this game", "PogChamp", "go left!!", "why democracy",
+           "hello chat", "anyone know the boss pattern?", "KEKW", "gg", "uuuuuh")
+
+
+class fakeauthor:
+
+    def __init__(self, name, uid):
+        self.name = name
+        self.id = uid
+        self.is_mod = False
+        self.badges = {}
+
+
+class fakechannel:
+
+    def __init__(self, name):
+        self.name = name
+        self.sent = []
+
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+class taggedcmd(int):
+    """Command id carrying its benchmark sequence number through the controller queue"""
+
+
+class fakectx:
+
+    def __init__(self, author, content, channel):
+        self.author = author
+        self.content = content
+        self.channel = channel
+
+
+def synthetic_chat(scenario, count, users, command_ratio, bot, rng):
+    """Generate list of (user, message) for the scenario"""
+
+    names = list(bot.table.ids)
+    modes = list(bot.mode_commands)
+    mode_ratio = MODES_VOTE_RATIO if scenario == "modes" else MODE_VOTE_RATIO
+    chat = []
+    for i in range(count):
+        user = f"user{rng.randrange(users)}"
+        roll = rng.random()
+        if i % CROWD_MESSAGES == 0:
+            crowd = rng.choice(names)
+        if roll < mode_ratio:
+            message = rng.choice(modes)
+        elif roll < mode_ratio + command_ratio:
+            if scenario == "communism":
+                message = ",".join(rng.choice(names) for _ in range(bot.plan_size))
+            elif scenario == "live" and rng.random() < CROWD_SHARE:
+                message = crowd
+            else:
+                message = rng.choice(names)
+        else:
+            message = rng.choice(CHATTER)
+        chat.append((user, message))
+    return chat
+
+
+def load_replay(path, config):
+    """Load recorded chat, one "user<TAB>message" per line, or an event log"""
+
+    with open(path, "rb") as f:
+        if f.read(len(eventlog.MAGIC)) == eventlog.MAGIC:
+            names = cmdparser.commandtable(config["commands"]).names
+            mode_names = {mode: name for name, mode in config["mode_commands"].items()}
+            return [(user, message) for _, user, message
+                    in eventlog.eventreader(path).chat(names, mode_names)]
+
+    chat = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            user, sep, message = line.rstrip("\n").partition("\t")
+            if sep:
+                chat.append((user, message))
+    return chat
+
+
+def bench_config(path, workdir, engine):
+    """Load config and point everything at the fake backend and a scratch directory"""
+
+    with open(path, "r") as f:
+        config = json.load(f)
+    config["backend"] = "fake"
+    config["controller_process"] = False
+    config["engine"] = engine
+    config["info_file"] = os.path.join(workdir, "info.txt")
+    config["vote_info_file"] = os.path.join(workdir, "vote_info.txt")
+    config["log_file"] = os.path.join(workdir, "log.txt")
+    config["metrics_port"] = 0
+    config["overlay_port"] = 0
+    config["journal_file"] = ""
+    config["event_log_file"] = ""
+    config["stats_file"] = ""
+    # Rounds are closed by the benchmark itself
+    config["vote_time"] = [3600, 3600]
+    config["mode_time"] = 3600
+    return config
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    idx = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def instrument(bot):
+    """Tag every command the bot executes and mark it on the fake device when
+    the controller presses it. Returns the list of (execute time, button),
+    indexed by sequence number.
+    """
+
+    accepted = []
+    execute = bot.execute
+    def tagged_execute(command, *args, **kwargs):
+        if isinstance(command, int):
+            command = taggedcmd(command)
+            command.seq = len(accepted)
+            accepted.append((time.monotonic(), bot.table.buttons[command]))
+        execute(command, *args, **kwargs)
+    bot.execute = tagged_execute
+
+    joy = bot.joy
+    button_press = joy._button_press
+    def marked_press(cmd):
+        seq = getattr(cmd, "seq", None)
+        if seq is not None:
+            joy.backend.mark(seq)
+        button_press(cmd)
+    joy._button_press = marked_press
+    return accepted
+
+
+def device_latencies(bot, accepted):
+    """Match each pressed command to the first device write after its press
+    setting its button. Presses of a button that is already held only extend
+    the hold and cause no device write, they are counted as merged and their
+    latency to the press is kept apart from the device write latencies.
+    Returns the sorted write latencies, sorted merged latencies and the
+    number of never pressed commands.
+    """
+
+    backend = bot.joy.backend
+    records = backend.records()
+    # Absolute write count of the oldest record left in the ring
+    offset = backend.count - len(records)
+    latencies = []
+    merged = []
+    for seq, count, pressed_at in backend.marks:
+        sent_at, button = accepted[seq]
+        bit = 1 << button
+        i = count - offset
+        if i < 0:
+            continue
+        if i and records[i - 1][1] & bit:
+            merged.append(pressed_at - sent_at)
+            continue
+        while i < len(records) and not records[i][1] & bit:
+            i += 1
+        if i < len(records):
+            latencies.append(records[i][0] - sent_at)
+    latencies.sort()
+    merged.sort()
+    return latencies, merged, len(accepted) - len(backend.marks)
+
+
+async def drive(bot, chat, channel, rate):
+    """Dispatch every message as its own task, like twitchio does.
+    Messages are paced to rate per second, 0 sends as fast as possible.
+    Returns elapsed time and the tasks.
+    """
+
+    authors = {}
+    tasks = []
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    for i, (user, message) in enumerate(chat):
+        author = authors.get(user)
+        if author is None:
+            author = authors[user] = fakeauthor(user, len(authors) + 1)
+        tasks.append(loop.create_task(bot.event_message(fakectx(author, message, channel))))
+        if rate:
+            await asyncio.sleep(max(0, start + (i + 1) / rate - time.perf_counter()))
+        elif i % 64 == 63:
+            await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    return elapsed, tasks
+
+
+async def close_round(bot, channel):
+    """Close the running vote round, returns duration in ms"""
+
+    bot.compiled = bot.compiled._replace(vote_time = (0, 0))
+    start = time.perf_counter()
+    if bot.mode == canalbot.DEMOCRACY:
+        await bot.process_command_votes(channel)
+    elif bot.mode == canalbot.COMMUNISM:
+        await bot.process_plan_votes(channel)
+    return (time.perf_counter() - start) * 1000
+
+
+def enter_mode(bot, mode):
+    bot.mode_change = mode
+    bot.set_mode(mode)
+
+
+async def run_scenario(bot, scenario, chat, rate, measure_memory):
+    channel = fakechannel(bot.channel)
+    if scenario == "democracy":
+        enter_mode(bot, canalbot.DEMOCRACY)
+    elif scenario == "communism":
+        enter_mode(bot, canalbot.COMMUNISM)
+    elif scenario == "live":
+        enter_mode(bot, canalbot.LIVE_DEMOCRACY)
+
+    if measure_memory:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+    accepted = instrument(bot)
+    elapsed, tasks = await drive(bot, chat, channel, rate)
+    if measure_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    result = {"messages": len(chat),
+              "elapsed_s": elapsed,
+              "msgs_per_sec": len(chat) / elapsed if elapsed > 0 else 0.0}
+
+    if scenario in ("democracy", "communism"):
+        result["voters"] = len(bot.votes)
+        result["round_close_ms"] = await close_round(bot, channel)
+
+    # Let the last presses reach the device
+    await asyncio.sleep(max(bot.table.holds) + 0.1)
+    if accepted:
+        latencies, merged, unpressed = device_latencies(bot, accepted)
+        result["latency_samples"] = len(latencies)
+        result["latency_p50_ms"] = percentile(latencies, 50) * 1000
+        result["latency_p99_ms"] = percentile(latencies, 99) * 1000
+        result["latency_p999_ms"] = percentile(latencies, 99.9) * 1000
+        result["presses_merged"] = len(merged)
+        result["merged_p50_ms"] = percentile(merged, 50) * 1000
+        result["commands_unpressed"] = unpressed
+
+    depth, dropped, coalesced = bot.joy.queue_stats()
+    updates, absorbed = bot.joy.update_stats()
+    result.update({"queue_dropped": dropped,
+                   "queue_coalesced": coalesced,
+                   "rate_limited": bot.ratelimit.limited,
+                   "device_updates": updates,
+                   "changes_per_update": absorbed})
+    if measure_memory:
+        result["memory_growth_kib"] = (current - before) / 1024
+        result["memory_peak_kib"] = peak / 1024
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions = True)
+    return result
+
+
+def run(args):
+    results = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "rate": args.rate,
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "engine": args.engine,
+               "scenarios": {}}
+    rng = random.Random(args.seed)
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory() as workdir:
+        config = bench_config(args.config, workdir, args.engine)
+        replay = load_replay(args.replay, config) if args.replay else None
+        for scenario in args.scenario:
+            result = None
+            # Second pass measures memory, tracemalloc would skew the timings
+            for measure_memory in (False, True):
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    bot = canalbot.CanalBot(dict(config))
+                    chat = replay or synthetic_chat(scenario, args.messages, args.users,
+                                                    args.command_ratio, bot, rng)
+                    outcome = loop.run_until_complete(run_scenario(bot, scenario, chat, args.rate,
+                                                                            measure_memory))
+                    bot.shutdown()
+                if result is None:
+                    result = outcome
+                else:
+                    result["memory_growth_kib"] = outcome["memory_growth_kib"]
+                    result["memory_peak_kib"] = outcome["memory_peak_kib"]
+            results["scenarios"][scenario] = result
+            print(f"{scenario}: " + ", ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}"
+                                              for k, v in result.items()))
+    return results
+
+
+def compare(old, new, threshold):
+    """Print metric changes against previous results. Returns number of regressions"""
+
+    regressions = 0
+    for scenario, result in new["scenarios"].items():
+        previous = old.get("scenarios", {}).get(scenario)
+        if previous is None:
+            continue
+        for key, direction in REGRESSION_KEYS.items():
+            if key not in result or key not in previous or not previous[key]:
+                continue
+            change = (result[key] - previous[key]) / abs(previous[key]) * 100
+            regressed = change * direction < -threshold
+            regressions += regressed
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{scenario}.{key}: {previous[key]:.3f} -> {result[key]:.3f} ({change:+.1f}%){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "CanalBot chat replay benchmark")
+    parser.add_argument("--config", default = "config.json")
+    parser.add_argument("--scenario", nargs = "+", choices = SCENARIOS, default = list(SCENARIOS))
+    parser.add_argument("--messages", type = int, default = 20000)
+    parser.add_argument("--users", type = int, default = 5000)
+    parser.add_argument("--command-ratio", type = float, default = 0.5)
+    parser.add_argument("--rate", type = float, default = 1000.0,
+                        help = "messages per second, 0 for as fast as possible")
+    parser.add_argument("--replay", help = "recorded chat, one user<TAB>message per line, or an event log")
+    parser.add_argument("--engine", choices = (canalbot.THREAD_ENGINE, canalbot.ASYNCIO_ENGINE),
+                        default = canalbot.THREAD_ENGINE)
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--output", help = "write results as JSON")
+    parser.add_argument("--compare", help = "previous results JSON to compare against")
+    parser.add_argument("--threshold", type = float, default = 10.0,
+                        help = "regression threshold in percent")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            old = json.load(f)
+        if compare(old, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,23 @@
 import os
 import json
+import contextlib
+import copy
 import threading
 import time
-import random
 import tcontroller as tc
+import fairqueue
 import filewriter as fw
+import backends
+import ratelimit
+import cmdparser
+import hotconfig
+import votes
+import chatsender
+import journal
+import eventlog
+import overlayfeed
+import metrics
+import pcontroller
 from twitchio.ext import commands
 import asyncio
 import concurrent.futures
@@ -14,13 +27,23 @@ ANARCHY = 0
 DEMOCRACY = 1
 COMMUNISM = 2
 NO_VOTE = 3
+LIVE_DEMOCRACY = 4
+
+# Execution engines
+THREAD_ENGINE = "thread"
+ASYNCIO_ENGINE = "asyncio"
 
 class CanalBot(commands.Bot):
 
     
     def __init__(self, cfgfile):
-        with open(cfgfile, 'r') as cfg:
-            config = json.load(cfg)
+        """Create the bot from config file path or an already loaded config dict"""
+        
+        if isinstance(cfgfile, dict):
+            config = cfgfile
+        else:
+            with open(cfgfile, 'r') as cfg:
+                config = json.load(cfg)
         super().__init__(irc_token=config["tmi_token"], 
                          client_id=config["client_id"], 
                          nick=config["bot_nick"], 
@@ -32,93 +55,219 @@ class CanalBot(commands.Bot):
         self.botname = config["bot_nick"]
         self.buttons = config["buttons"]
         self.prefix = config["bot_prefix"]
-        self.commands = config["commands"]
-        self.mode_commands = config["mode_commands"]
-        self.plan_size = config["plan_size"]
-        self.msg_queue = []
-        
-        # Command UTF formatting for logging use
-        self.cmd_utf = config["cmd_utf"]
+        # Commands, glyphs, hold and vote times. Replaced as a whole when config.json changes
+        self.compiled = hotconfig.compile_config(config, self.buttons)
+        self.ratelimit = ratelimit.tokenbuckets(config.get("user_rate", ratelimit.USER_RATE),
+                                                config.get("user_burst", ratelimit.USER_BURST))
+        # Outbound chat, sent from its own task so vote processing never waits on sends
+        self.chat = chatsender.chatsender(self.loop,
+                                          config.get("chat_rate", chatsender.CHAT_RATE),
+                                          config.get("chat_burst", chatsender.CHAT_BURST))
         
         # Voting variables
-        self.votes = config["commands"]
-        self.vote_time = config["vote_time"]
-        self.mode_time = config["mode_time"]
+        self.votes = None
         self.vote_timer = False
-        self.mode_timer = False
+        self.mode_task = None
+        self.mode_wakeup = asyncio.Event()
         
         # Democracy/Anarchy mode variables
         self.voterounds = 0
         self.mode_change = NO_CHANGE
         self.mode = ANARCHY
-        self.voters = dict()
-        self.cmdvoters = []
+        self.voters = votes.voterregistry(LIVE_DEMOCRACY + 1, config.get("voter_idle", votes.VOTER_IDLE))
+        self.journal = None
+        self.feed = None
+        self.live_task = None
         
-        # Filewriters
-        self.fw_info = fw.filewriter(config["info_file"], "w")
-        self.fw_vinfo = fw.filewriter(config["vote_info_file"], "w")
-        self.fw_log = fw.filewriter(config["log_file"], "a")
+        # Execution engine. The asyncio engine runs controller and writers on the 
+        # bot's own event loop instead of separate threads.
+        self.engine = config.get("engine", THREAD_ENGINE)
+        if self.engine not in (THREAD_ENGINE, ASYNCIO_ENGINE):
+            raise ValueError(f"Unknown engine: {self.engine}")
         
-        self.fw_info.daemon = True
-        self.fw_vinfo.daemon = True
-        self.fw_log.daemon = True
+        # Filewriters
+        overlay_fps = config.get("overlay_fps", fw.OVERLAY_FPS)
+        log_args = (config["log_file"], "a",
+                    config.get("log_flush_bytes", fw.FLUSH_BYTES),
+                    config.get("log_flush_interval", fw.FLUSH_INTERVAL),
+                    config.get("log_rotate_bytes", 0),
+                    config.get("log_rotate_daily", False))
+        if self.engine == ASYNCIO_ENGINE:
+            self.fw_info = fw.aiooverlaywriter(self.loop, config["info_file"], overlay_fps)
+            self.fw_vinfo = fw.aiooverlaywriter(self.loop, config["vote_info_file"], overlay_fps)
+            self.fw_log = fw.aiofilewriter(self.loop, *log_args)
+        else:
+            self.fw_info = fw.overlaywriter(config["info_file"], overlay_fps)
+            self.fw_vinfo = fw.overlaywriter(config["vote_info_file"], overlay_fps)
+            self.fw_log = fw.filewriter(*log_args)
+            
+            self.fw_info.daemon = True
+            self.fw_vinfo.daemon = True
+            self.fw_log.daemon = True
         
         self.fw_info.start()
         self.fw_vinfo.start()
         self.fw_log.start()
         
-        #Locks
-        self.votes_lock = threading.Lock()
-        self.voters_lock = threading.Lock()
-        self.thread_lock = threading.Lock()
-        
-        # Init and reset controller. Reset votes
-        self.joy = tc.tController(self.buttons,
-                                  self.commands.copy(), 
-                                  config["holdtime"], 
-                                  config["holdtime_long"])
-        self.joy.daemon = True
+        # Locks. Everything runs on the event loop with the asyncio engine, no locking needed
+        if self.engine == ASYNCIO_ENGINE:
+            self.votes_lock = contextlib.nullcontext()
+            self.voters_lock = contextlib.nullcontext()
+        else:
+            self.votes_lock = threading.Lock()
+            self.voters_lock = threading.Lock()
+        
+        # Init and reset controller. Reset votes. With controller_process the
+        # controller runs in its own process, fed over a shared memory ring buffer
+        self.controller_process = config.get("controller_process", False)
+        self.priority_lanes = config.get("priority_lanes", True)
+        if self.controller_process:
+            backend = config.get("backend", "vjoy")
+        else:
+            backend = backends.create_backend(config.get("backend", "vjoy"), 
+                                              config.get("device", 1))
+        controller_args = (self.buttons,
+                           self.table, 
+                           config.get("frame_time", tc.FRAME_TIME),
+                           backend,
+                           config.get("queue_size", tc.QUEUE_SIZE),
+                           config.get("queue_policy", tc.DROP_OLDEST),
+                           config.get("max_programs", tc.MAX_PROGRAMS),
+                           config.get("priority_burst", fairqueue.PRIORITY_BURST))
+        if self.controller_process:
+            self.joy = pcontroller.pController(self.loop, *controller_args,
+                                               device = config.get("device", 1),
+                                               ring_size = config.get("ring_size", pcontroller.RING_SIZE))
+        elif self.engine == ASYNCIO_ENGINE:
+            self.joy = tc.aController(self.loop, *controller_args)
+        else:
+            self.joy = tc.tController(*controller_args)
+            self.joy.daemon = True
+        self.joy.sequence_progress = self.plan_progress
         self.joy.start()
         self.joy.reset()
         
         self.init_democratic_vote()
+        self.fw_vinfo.set("Anarchy active, anything goes")
+        
+        # State journal. Restores mode, voters, votes and queued sequences of the previous run
+        journal_file = config.get("journal_file", "")
+        if journal_file:
+            self.init_journal(config, journal_file)
         self.update_info()
-        self.fw_vinfo.queue("Anarchy active, anything goes")
+        
+        # Binary event log of every handled command, for analysis and replay
+        self.event_log = None
+        event_log_file = config.get("event_log_file", "")
+        if event_log_file:
+            self.event_log = eventlog.eventlog(self.loop, event_log_file,
+                                               config.get("log_flush_bytes", eventlog.FLUSH_BYTES),
+                                               config.get("log_flush_interval", eventlog.FLUSH_INTERVAL),
+                                               self.botname.lower())
+        
+        # Optional WebSocket push of the overlay state
+        overlay_port = config.get("overlay_port", 0)
+        if overlay_port:
+            self.feed = overlayfeed.overlayfeed(self.loop, overlay_port,
+                                                config.get("overlay_host", "127.0.0.1"))
+            self.loop.create_task(self.feed.start())
+            self.update_info()
+        
+        self.init_metrics(config)
+        
+        # Reload config.json when it changes. Not available for configs given as dict
+        self.watcher = None
+        reload_interval = config.get("config_reload_interval", hotconfig.RELOAD_INTERVAL)
+        if not isinstance(cfgfile, dict) and reload_interval:
+            self.watcher = hotconfig.configwatcher(self.loop, cfgfile, self.reload_config, reload_interval)
+            self.watcher.start()
+
+
+    @property
+    def table(self):
+        return self.compiled.table
+
+
+    @property
+    def parser(self):
+        return self.compiled.parser
+
+
+    @property
+    def mode_commands(self):
+        return self.compiled.mode_commands
+
+
+    @property
+    def vote_time(self):
+        return self.compiled.vote_time
+
+
+    @property
+    def mode_time(self):
+        return self.compiled.mode_time
+
+
+    @property
+    def plan_size(self):
+        return self.compiled.plan_size
+
+
+    def reload_config(self, config):
+        """Compile the changed config and swap it in. 
+        Invalid config is rejected and the current one kept.
+        """
+        
+        try:
+            compiled = hotconfig.compile_config(config, self.buttons, self.compiled)
+        except ValueError as e:
+            print(f"Config reload rejected: {e}")
+            return
+        
+        with self.votes_lock:
+            # New commands get new ids, the running round must be able to count them
+            size = len(compiled.table)
+            if size != len(self.table):
+                self.votes.resize(size)
+                self.record(journal.TABLE, compiled.table.names)
+            self.compiled = compiled
+            self.joy.set_table(compiled.table)
+            # Plans of a different length can not be counted together
+            if isinstance(self.votes, votes.planround) and self.votes.plan_size != compiled.plan_size:
+                self.init_communist_vote()
+        print("Config reloaded")
 
 
     async def event_ready(self):
         """Bot ready event - Simply prints message to show that bot activated"""
         
         print(f"{self.botname} is online!")        
+        self.start_mode_check()
 
 
     async def event_join(self, user):
         """Bot function to handle joining users.
-        Adds new users to the voters dictionary.
+        Adds new users to the voter registry.
         """
         
         # Do not put bot in the voter list
         if user.name.rstrip().lower() == self.botname.lower():
             return
         
-        print("User joined: " + user.name)
-        
-        self.voters_lock.acquire()
-        if not user.name in self.voters:
-            self.voters[user.name.lower()] = NO_VOTE
-        self.voters_lock.release()
+        with self.voters_lock:
+            if self.voters.join(user.name.lower(), NO_VOTE):
+                self.record(journal.VOTER, user.name.lower(), NO_VOTE)
         
         
     async def event_part(self, user):
         """Bot function to handle parting users.
-        Changes the voters dictionary to match users in chat
+        Changes the voter registry to match users in chat
         """
         
-        self.voters_lock.acquire()
-        if user.name.lower() in self.voters:
-            self.voters.pop(user.name.lower())
-        self.update_info()
-        self.voters_lock.release()
+        with self.voters_lock:
+            if self.voters.remove(user.name.lower()):
+                self.record(journal.VOTER, user.name.lower(), None)
+            self.update_info()
         
 
     async def event_message(self, ctx):
@@ -130,46 +279,62 @@ class CanalBot(commands.Bot):
         if ctx.author.name.lower() == self.botname.lower():
             return
 
-        content = ctx.content.replace(" ","").lower()
-
-        if self.prefix != "":
-            parts = content.split(self.prefix)
-            if len(parts) == 2:
-                content = parts[1]
-            else:
-                return
+        self.m_received.inc()
+        with self.voters_lock:
+            self.voters.touch(ctx.author.name.lower())
+        compiled = self.compiled
+        parsed = compiled.parser.parse(ctx.content)
+        if parsed is None:
+            self.m_not_command.inc()
+            return
+        kind, content = parsed
 
-        if content in self.mode_commands:
+        if kind == cmdparser.MODE_VOTE:
             await self.mode_vote(ctx.author.name.lower(), content)
             return
             
-        if self.mode == COMMUNISM:
-            content = content.split(",")
-
-        if self.check_content(content):
-            print(f"Something valid : {content}")
-            print(f"Mode : {self.mode}")
-            if self.mode == DEMOCRACY:
-                await self.vote(content, ctx.author.name.lower(), ctx.channel)
-            elif self.mode == COMMUNISM:
+        if kind == cmdparser.PROGRAM:
+            # Programs are anarchy only
+            user = ctx.author.name.lower()
+            if self.mode != ANARCHY:
+                self.m_invalid.inc()
+            elif self.ratelimit.allow(user, max(1, sum(1 for mask, _ in content if mask))):
+                # Waits are free, each pressing step costs a token
+                self.execute(content, user)
+                self.log_event(user, eventlog.PROGRAM, len(content))
+                self.fw_log.queue(f"{ctx.content.strip()} (Program)\n")
+            return
+            
+        if self.mode == DEMOCRACY:
+            if len(content) == 1:
+                await self.vote(content[0], ctx.author.name.lower(), ctx.channel)
+            else:
+                self.m_invalid.inc()
+                self.log_message(ctx.author.name.lower(), eventlog.DROPPED, content)
+        elif self.mode == COMMUNISM:
+            if len(content) == compiled.plan_size:
                 await self.communist_vote(content, ctx.author.name.lower(), ctx.channel)
             else:
-                self.execute(content)
-                utf = self.get_cmd_utf(content)
-                self.fw_log.queue(f"{utf}\n")
-    
-    
-    def check_content(self, content):
-        if self.mode != COMMUNISM:
-            if content not in self.commands:
-                return False
-            return True
+                self.m_invalid.inc()
+                self.log_message(ctx.author.name.lower(), eventlog.DROPPED, content)
+        elif self.mode == LIVE_DEMOCRACY:
+            if len(content) == 1:
+                self.live_vote(content[0], ctx.author.name.lower())
+            else:
+                self.m_invalid.inc()
+                self.log_message(ctx.author.name.lower(), eventlog.DROPPED, content)
         else:
-            for i in content:
-                if i not in self.commands:
-                    return False
-            return True
-                  
+            user = ctx.author.name.lower()
+            if not self.ratelimit.allow(user, len(content)):
+                self.log_message(user, eventlog.DROPPED, content)
+                return
+            priority = self.command_priority(ctx.author)
+            for cid in content:
+                self.execute(cid, user, priority)
+            self.log_message(user, eventlog.EXECUTED, content)
+            utf = "".join(self.get_cmd_utf(cid) for cid in content)
+            self.fw_log.queue(f"{utf}\n")
+    
 
     
     async def vote(self, command, user, channel):
@@ -178,25 +343,37 @@ class CanalBot(commands.Bot):
         Additionally, timer thread to process the votes is started if it was not running already.
         """
         
-        if user in self.cmdvoters:
-            return
-        if command in self.votes:
-            with self.votes_lock:
-                self.votes[command] += 1
-                self.cmdvoters.append(user)                
-            
-            utf = self.get_cmd_utf(command)
-            self.fw_log.queue(f"{utf} (Vote)\n")
+        with self.votes_lock:
+            leader = self.votes.leader
+            if not self.votes.vote(user, command):
+                self.m_invalid.inc()
+                self.log_event(user, eventlog.DROPPED, command)
+                return
+            self.record(journal.VOTE, user, command)
+        self.log_event(user, eventlog.VOTED, command)
             
-            if not self.vote_timer:
-                self.vote_timer = True
-                await channel.send(f"Voting started. Vote time {self.vote_time[0] + self.vote_time[1]} seconds")
-                print("Voting started")
-                self.fw_vinfo.clear()
-                self.fw_vinfo.queue(f"Democracy rules supreme\n")
-                self.fw_vinfo.queue(f"Now voting next command...\n")
-                await asyncio.sleep(self.vote_time[0])
-                await self.process_command_votes(channel)
+        utf = self.get_cmd_utf(command)
+        self.fw_log.queue(f"{utf} (Vote)\n")
+        
+        if self.vote_timer:
+            # Live leader for the overlay, only rewritten when the lead changes
+            if leader != self.votes.leader:
+                leading = self.get_cmd_utf(self.votes.leader)
+                self.fw_vinfo.set(f"Democracy rules supreme\n"
+                                  f"Now voting next command...\n"
+                                  f"Leading: {leading}\n")
+                self.publish(leader = leading)
+        else:
+            self.vote_timer = True
+            self.round_started = time.monotonic()
+            self.chat.send(channel, f"Voting started. Vote time {self.vote_time[0] + self.vote_time[1]} seconds", "vote")
+            print("Voting started")
+            self.fw_vinfo.set(f"Democracy rules supreme\n"
+                              f"Now voting next command...\n"
+                              f"Leading: {utf}\n")
+            self.publish(voting = True, leader = utf, winner = None)
+            await asyncio.sleep(self.vote_time[0])
+            await self.process_command_votes(channel)
     
         
     async def process_command_votes(self, channel):
@@ -205,190 +382,469 @@ class CanalBot(commands.Bot):
         Resets the voting after done.
         """
         
-        await channel.send(f"Voting ends in {self.vote_time[1]} seconds")
+        self.chat.send(channel, f"Voting ends in {self.vote_time[1]} seconds", "vote")
         await asyncio.sleep(self.vote_time[1])
         
+        # Never await while holding the lock
         with self.votes_lock:
             self.vote_timer = False
             if not self.mode == DEMOCRACY:
-                print("cancelled")
-                await channel.send(f"Mode changed, vote cancelled")
-                self.cmdvoters = []
-                return
-            
-            print("Voting concluded")
-            self.cmdvoters = []
-            winner = max(self.votes, key = self.votes.get)
-            print(f"Winner: {winner}, {self.votes[winner]}")
-            if self.votes[winner] > 0:
-                self.execute(str(winner))
-                utf = self.get_cmd_utf(winner)
-                await channel.send(f"Voting finished. Most votes for: {utf}")
-                self.fw_log.queue(f"{utf} (Executed)\n")
-                self.fw_vinfo.clear()
-                self.fw_vinfo.queue(f"Democracy rules supreme\n")
-                self.fw_vinfo.queue(f"Voting finished, winner: {utf}\n")
-        self.init_democratic_vote()
+                cancelled = True
+            else:
+                cancelled = False
+                winner = self.votes.winner()
+                best = self.votes.best
+                self.round_closed(DEMOCRACY)
+                self.init_democratic_vote()
+        
+        if cancelled:
+            print("cancelled")
+            self.publish(voting = False, leader = None)
+            self.chat.drop(channel, "vote")
+            self.chat.send(channel, f"Mode changed, vote cancelled", "vote_result")
+            return
+        
+        print("Voting concluded")
+        print(f"Winner: {winner}, {best}")
+        self.publish(voting = False, leader = None,
+                     winner = self.get_cmd_utf(winner) if winner is not None else None,
+                     winner_votes = best)
+        if winner is not None:
+            self.execute(winner)
+            self.log_event(eventlog.BOT, eventlog.WON, winner)
+            utf = self.get_cmd_utf(winner)
+            self.fw_log.queue(f"{utf} (Executed)\n")
+            self.fw_vinfo.set(f"Democracy rules supreme\n"
+                              f"Voting finished, winner: {utf}\n")
+            self.chat.drop(channel, "vote")
+            self.chat.send(channel, f"Voting finished. Most votes for: {utf}", "vote_result")
     
 
     async def communist_vote(self, plan, user, channel):
+        """Vote for given plan, a list of plan_size command ids"""
     
-        if user in self.cmdvoters:
+        if len(plan) != self.plan_size:
             return
-        if len(plan) == len(self.votes):
-            utf = ""
-            with self.votes_lock:
-                for i,vote in enumerate(plan):
-                    self.votes[i][vote] += 1
-                    #if i != 0:
-                    #    utf += ","
-                    utf += self.get_cmd_utf(vote)
-                self.cmdvoters.append(user)
-                
-            self.fw_log.queue(f"{utf} (Voted plan)\n")
-            if not self.vote_timer:
-                self.vote_timer = True
-                await channel.send(f"Voting for next 5 command plan started. Vote time {self.vote_time[0] + self.vote_time[1]} seconds")
-                self.fw_vinfo.clear()
-                self.fw_vinfo.queue(f"Communist Comrades' Command Plan active\n")
-                self.fw_vinfo.queue(f"Vote for next {self.plan_size} commands comrade\n")
-                await asyncio.sleep(self.vote_time[0])
-                await self.process_plan_votes(channel)
+        with self.votes_lock:
+            if not self.votes.vote(user, plan):
+                self.m_invalid.inc()
+                self.log_message(user, eventlog.DROPPED, plan)
+                return
+            self.record(journal.PLAN, user, plan)
+        self.log_message(user, eventlog.PLAN, plan)
+        
+        utf = "".join(self.get_cmd_utf(vote) for vote in plan)
+        self.fw_log.queue(f"{utf} (Voted plan)\n")
+        if not self.vote_timer:
+            self.vote_timer = True
+            self.round_started = time.monotonic()
+            self.chat.send(channel, f"Voting for next {self.plan_size} command plan started. "
+                                    f"Vote time {self.vote_time[0] + self.vote_time[1]} seconds", "plan")
+            self.fw_vinfo.set(f"Communist Comrades' Command Plan active\n"
+                              f"Vote for next {self.plan_size} commands comrade\n")
+            self.publish(voting = True)
+            await asyncio.sleep(self.vote_time[0])
+            await self.process_plan_votes(channel)
                 
 
     async def process_plan_votes(self, channel):
         """Process all given communist plan votes and calculate results"""
         
-        await channel.send(f"Plan voting ends in {self.vote_time[1]} seconds")
+        self.chat.send(channel, f"Plan voting ends in {self.vote_time[1]} seconds", "plan")
         await asyncio.sleep(self.vote_time[1])
         
-        result = []
-        utf = ""
-
+        # Never await while holding the lock
         with self.votes_lock:
             self.vote_timer = False
             if not self.mode == COMMUNISM:
-                self.cmdvoters = []
                 return
-            for i,v in enumerate(self.votes):
-                result.append(self.dict_rng_max(self.votes[i]))
+            result = self.votes.winners()
             print(f"Result: {result}")
+            self.round_closed(COMMUNISM)
             self.init_communist_vote()
-            self.execute(result)
-            
-            self.cmdvoters = []
-            for i,v in enumerate(result):
-                #if i != 0:
-                #    utf += ","
-                utf += self.get_cmd_utf(v)
-            await channel.send(f"Comrades, new 5 command plan decided: {utf}")
-         
+        if result is None:
+            self.publish(voting = False)
+            return
+        
+        utf = "".join(self.get_cmd_utf(v) for v in result)
         self.fw_log.queue(f"{utf} (Winning plan)\n")
-        self.fw_vinfo.clear()
-        self.fw_vinfo.queue(f"Communist Comrades' Command Plan active\n")
-        self.fw_vinfo.queue(f"Combined winning plan: {utf}\n")
+        self.fw_vinfo.set(f"Communist Comrades' Command Plan active\n"
+                          f"Combined winning plan: {utf}\n")
+        self.publish(voting = False, plan = [self.get_cmd_utf(v) for v in result], plan_step = None)
+        # Plan progress replaces the overlay text once execution starts
+        self.execute(result)
+        self.log_message(eventlog.BOT, eventlog.WON, result)
+        self.chat.drop(channel, "plan")
+        self.chat.send(channel, f"Comrades, new {self.plan_size} command plan decided: {utf}", "plan_result")
 
     
-    def execute(self, command):
-        """Executes given command"""
+    def live_vote(self, command, user):
+        """Add a decaying vote for command in live democracy.
+        Users may vote repeatedly within their rate limit.
+        """
+        
+        if not self.ratelimit.allow(user):
+            self.log_event(user, eventlog.DROPPED, command)
+            return
+        with self.votes_lock:
+            self.votes.vote(command)
+        self.log_event(user, eventlog.VOTED, command)
+        self.fw_log.queue(f"{self.get_cmd_utf(command)} (Live vote)\n")
+    
+    
+    async def live_ticks(self):
+        """Execute the live democracy leader every live_tick seconds while the mode lasts.
+        The leader needs live_min_share of the decayed votes and a decayed count 
+        of live_min_weight. Its votes are spent when executed.
+        """
+        
+        while self.mode == LIVE_DEMOCRACY:
+            compiled = self.compiled
+            await asyncio.sleep(compiled.live_tick)
+            if self.mode != LIVE_DEMOCRACY:
+                break
+            with self.votes_lock:
+                leading = self.votes.leading()
+                if leading is None:
+                    continue
+                command, weight, share = leading
+                if weight < compiled.live_min_weight or share < compiled.live_min_share:
+                    continue
+                self.votes.spend(command)
+            self.execute(command)
+            self.log_event(eventlog.BOT, eventlog.WON, command)
+            utf = self.get_cmd_utf(command)
+            self.fw_log.queue(f"{utf} (Executed)\n")
+            self.fw_vinfo.set(f"Live democracy, the crowd steers\n"
+                              f"Executing: {utf} ({share:.0%})\n")
+            self.publish(winner = utf, winner_share = round(share, 3))
+        self.live_task = None
+    
+    
+    def start_live(self):
+        """Start the live democracy tick task unless already running"""
+        
+        if self.live_task is None:
+            self.live_task = self.loop.create_task(self.live_ticks())
+    
+    
+    def command_priority(self, author):
+        """Return the controller queue priority for commands of the message author"""
+        
+        if not self.priority_lanes:
+            return fairqueue.PRIORITY_CHAT
+        if "broadcaster" in author.badges:
+            return fairqueue.PRIORITY_STREAMER
+        if author.is_mod:
+            return fairqueue.PRIORITY_MOD
+        return fairqueue.PRIORITY_CHAT
+    
+    
+    def execute(self, command, user = None, priority = fairqueue.PRIORITY_CHAT):
+        """Executes given command id, plan (list of command ids) or compiled program (tuple)"""
         
-        if isinstance(command, str) :
-            print(f"Executing: {command}")
-            self.joy.queue_command(command)
+        if isinstance(command, int) :
+            self.m_executed.inc()
+            self.joy.queue_command(command, user, priority)
         elif isinstance(command, list):
-            print(f"Executing communist plan: {command}")
+            self.m_executed.inc(len(command))
+            self.record(journal.SEQUENCE, command)
             self.joy.queue_sequence(command)
+        elif isinstance(command, tuple):
+            self.m_executed.inc()
+            self.joy.queue_program(command)
+    
+    
+    def init_journal(self, config, journal_file):
+        """Load the previous state if any and start the journal"""
+        
+        snapshot_file = config.get("snapshot_file", journal_file + ".snapshot")
+        restored = journal.load(snapshot_file, journal_file, self.table.names)
+        self.journal = journal.journal(journal_file, snapshot_file,
+                                       restored or journal.state(self.table.names),
+                                       config.get("journal_interval", journal.JOURNAL_INTERVAL),
+                                       config.get("snapshot_interval", journal.SNAPSHOT_INTERVAL),
+                                       config.get("snapshot_events", journal.SNAPSHOT_EVENTS))
+        self.journal.daemon = True
+        self.joy.sequence_started = lambda: self.journal.record(journal.SEQUENCE_START)
+        
+        if restored is None:
+            self.record(journal.MODE, self.mode, self.mode_change)
+            self.record(journal.ROUND, 0)
+        else:
+            self.restore(restored)
+        # The journal thread owns the restored state from here on
+        self.journal.start()
+    
+    
+    def restore(self, restored):
+        """Continue from the state of the previous run"""
+        
+        if restored.mode is None:
+            # Nothing usable was journaled, start fresh
+            self.record(journal.MODE, self.mode, self.mode_change)
+            self.record(journal.ROUND, 0)
+            self.record(journal.CLEAR_SEQUENCES)
+            return
+        self.mode = restored.mode
+        self.mode_change = restored.mode_change
+        self.voters.load(restored.voters)
+        if self.mode == COMMUNISM:
+            self.joy.set_sequential_mode()
+            self.fw_vinfo.set("Communist Comrades' Command Plan active\n")
+        elif self.mode == DEMOCRACY:
+            self.fw_vinfo.set("Democracy rules supreme")
+        
+        # Command ids are only meaningful for the same command table, and the
+        # round has to be the one of the mode, with plans of the configured size
+        if self.mode == COMMUNISM:
+            fits = (isinstance(restored.votes, votes.planround)
+                    and restored.votes.plan_size == self.plan_size)
+        else:
+            fits = isinstance(restored.votes, votes.voteround)
+        if fits and getattr(restored, "names", None) == self.table.names:
+            self.votes = copy.deepcopy(restored.votes)
+            for seq in restored.sequences:
+                self.joy.queue_sequence(seq)
+        else:
+            self.record(journal.TABLE, self.table.names)
+            self.record(journal.CLEAR_SEQUENCES)
+            if self.mode == COMMUNISM:
+                self.init_communist_vote()
+            else:
+                self.init_democratic_vote()
+        # Live votes fade within seconds and are not journaled
+        if self.mode == LIVE_DEMOCRACY:
+            self.fw_vinfo.set("Live democracy, the crowd steers")
+            self.init_live_vote()
+            self.start_live()
+        print(f"Restored {self.get_mode()} with {len(self.voters)} voters and {len(self.votes)} votes")
+    
+    
+    def record(self, kind, *args):
+        """Record a state change to the journal, if enabled"""
+        
+        if self.journal is not None:
+            self.journal.record(kind, *args)
+    
+    
+    def log_event(self, user, outcome, cmd, step = 0, steps = 1):
+        """Add a command event to the event log, if enabled"""
+        
+        if self.event_log is not None:
+            self.event_log.record(time.time(), user, self.mode, outcome, cmd, step, steps)
+    
+    
+    def publish(self, **state):
+        """Push overlay state changes to the WebSocket feed, if enabled"""
+        
+        if self.feed is not None:
+            self.feed.publish(**state)
+    
+    
+    def log_message(self, user, outcome, content):
+        """Add the events of a multi-command message or plan to the event log, if enabled"""
+        
+        if self.event_log is not None:
+            now = time.time()
+            for i, cid in enumerate(content):
+                self.event_log.record(now, user, self.mode, outcome, cid, i, len(content))
+    
+    
+    def init_metrics(self, config):
+        """Create the metrics registry and start the configured exports.
+        Hot path counters are kept as attributes, everything else is read at export time.
+        """
+        
+        m = self.metrics = metrics.registry()
+        self.m_received = m.counter("messages_received_total", "Chat messages received")
+        self.m_not_command = m.counter("messages_rejected_total", "Chat messages rejected",
+                                       {"reason": "not_command"})
+        self.m_invalid = m.counter("messages_rejected_total", "Chat messages rejected",
+                                   {"reason": "invalid_vote"})
+        m.counter_function("messages_rejected_total", "Chat messages rejected",
+                           lambda: self.ratelimit.limited, {"reason": "rate_limited"})
+        self.m_executed = m.counter("commands_executed_total", "Commands sent to the controller")
+        m.counter_function("commands_dropped_total", "Commands dropped by the controller queue policy",
+                           lambda: self.joy.dropped)
+        m.counter_function("commands_coalesced_total", "Commands merged by the controller queue policy",
+                           lambda: self.joy.coalesced)
+        m.gauge("queue_depth", "Commands waiting in the controller queue", lambda: self.joy.queue_stats()[0])
+        m.counter_function("device_updates_total", "Device writes", lambda: self.joy.update_count)
+        m.counter_function("releases_total", "Timed button releases", lambda: self.joy.hold_count)
+        m.gauge("release_error_ms", "Button release time error", lambda: self.joy.hold_stats()[1],
+                {"stat": "mean"})
+        m.gauge("release_error_ms", "Button release time error", lambda: self.joy.hold_stats()[2],
+                {"stat": "max"})
+        self.m_round_seconds = {}
+        self.m_round_voters = {}
+        for mode, name in ((DEMOCRACY, "democracy"), (COMMUNISM, "communism")):
+            self.m_round_seconds[mode] = m.summary("vote_round_seconds", "Vote round duration",
+                                                   {"mode": name})
+            self.m_round_voters[mode] = m.summary("vote_round_voters", "Voters per vote round",
+                                                  {"mode": name})
+        m.gauge("mode", "Current mode, 0 anarchy, 1 democracy, 2 communism, 4 live democracy",
+                lambda: self.mode)
+        m.gauge("mode_voters", "Users in the mode voter list", lambda: len(self.voters))
+        for name, writer in (("info", self.fw_info), ("vote_info", self.fw_vinfo), ("log", self.fw_log)):
+            m.gauge("filewriter_backlog", "Items queued but not yet written", writer.backlog,
+                    {"file": name})
+        m.counter_function("chat_sent_total", "Chat messages sent", lambda: self.chat.sent)
+        m.counter_function("chat_merged_total", "Unsent chat messages superseded by newer ones",
+                           lambda: self.chat.merged)
+        m.gauge("chat_pending", "Chat messages waiting to be sent", lambda: len(self.chat))
+        if self.journal is not None:
+            m.gauge("filewriter_backlog", "Items queued but not yet written", self.journal.backlog,
+                    {"file": "journal"})
+        m.counter_function("log_lines_total", "Lines written to the log file", lambda: self.fw_log.lines)
+        if self.event_log is not None:
+            m.gauge("filewriter_backlog", "Items queued but not yet written", self.event_log.backlog,
+                    {"file": "event_log"})
+            m.counter_function("events_logged_total", "Events written to the event log",
+                               lambda: self.event_log.events)
+        if self.feed is not None:
+            m.gauge("overlay_clients", "Connected overlay feed clients", lambda: len(self.feed))
+        
+        self.round_started = time.monotonic()
+        port = config.get("metrics_port", 0)
+        if port:
+            self.metrics.serve(port)
+        stats_file = config.get("stats_file", "")
+        if stats_file:
+            loop = self.loop if self.engine == ASYNCIO_ENGINE else None
+            self.metrics.write_periodically(stats_file, config.get("stats_interval", 10), loop)
+    
+    
+    def round_closed(self, mode):
+        """Record duration and voter count of the closing vote round"""
+        
+        self.m_round_seconds[mode].observe(time.monotonic() - self.round_started)
+        self.m_round_voters[mode].observe(len(self.votes))
+    
+    
+    def plan_progress(self, plan, step):
+        """Show the executing plan step on the vote info overlay.
+        Called by the controller, from the scheduler thread with the thread engine.
+        """
+        
+        utf = "".join(self.get_cmd_utf(cid) for cid in plan)
+        self.fw_vinfo.set(f"Communist Comrades' Command Plan active\n"
+                          f"Executing plan: {utf}\n"
+                          f"Step {step + 1}/{len(plan)}: {self.get_cmd_utf(plan[step])}\n")
+        if self.feed is not None:
+            self.feed.publish_threadsafe(plan = [self.get_cmd_utf(cid) for cid in plan], plan_step = step)
     
     
     def init_democratic_vote(self):
-        """Sets the votes for democratic mode.
+        """Sets the votes for democratic mode. An existing vote round is reused.
         Ensure that you have acquired the votes_lock as this is not done here!
         """
     
-        self.votes = dict.fromkeys(self.commands)
-        for k in self.votes:
-            self.votes[k] = 0
+        if isinstance(self.votes, votes.voteround):
+            self.votes.reset()
+        else:
+            self.votes = votes.voteround(len(self.table))
+        self.record(journal.ROUND, 0)
     
     
-    def init_communist_vote(self):
-        """Sets the votes for communist mode.
+    def init_live_vote(self):
+        """Sets the decaying votes for live democracy.
         Ensure that you have acquired the votes_lock as this is not done here!
         """
-
-        self.votes = []
-        for i in range(self.plan_size):
-            self.votes.append(dict.fromkeys(self.commands,0))
         
+        self.votes = votes.decayround(len(self.table), self.compiled.live_halflife)
     
-    def dict_rng_max(self, dct):
-        """Modified max value from dictionary. 
-        If multiple keys have same value, pick one at random"""
-        
-        if len(dct) == 0:
-            return
-        loop = True
-        bestvalue = 0
-        contenders = []
-        bestvalue = dct[max(dct, key = dct.get)]
-        while(loop and len(dct) > 0):
-            contender = max(dct, key = dct.get)
-            if dct[contender] == bestvalue:
-                contenders.append(contender) 
-                dct.pop(contender)
-            else:
-                loop = False
-        return contenders[random.randint(0,len(contenders) - 1)]
     
+    def init_communist_vote(self):
+        """Sets the votes for communist mode. An existing plan round is reused.
+        Ensure that you have acquired the votes_lock as this is not done here!
+        """
+
+        if isinstance(self.votes, votes.planround) and self.votes.plan_size == self.plan_size:
+            self.votes.reset()
+        else:
+            self.votes = votes.planround(self.plan_size, len(self.table))
+        self.record(journal.ROUND, self.plan_size)
+        
     
     async def mode_vote(self, user, vote):
         """Process the user vote for modechange
-        Marks the given vote to specific user.
-        Launches the mode checking timer if not already running
+        Marks the given vote to specific user and wakes up the mode check
         """
         
         if user == self.botname.lower():
             return
 
-        value = self.mode_commands[vote]
+        value = self.mode_commands.get(vote)
+        if value is None:
+            return
                 
         with self.voters_lock:
-            # Mode must be 0,1,2 (anarchy/democracy/communism)
-            if value == ANARCHY or value == DEMOCRACY or value == COMMUNISM:
-                self.voters[user] = value
+            # Mode must be 0,1,2,4 (anarchy/democracy/communism/live democracy)
+            if value == ANARCHY or value == DEMOCRACY or value == COMMUNISM or value == LIVE_DEMOCRACY:
+                self.voters.set(user, value)
+                self.record(journal.VOTER, user, value)
+        self.log_event(user, eventlog.MODE_VOTE, value)
                 
         self.update_info()
-        if not self.mode_timer:
-            print("Mode change check started")
-            self.mode_timer = True
-            await asyncio.sleep(self.mode_time)
-            await self.mode_check()
+        self.start_mode_check()
+        self.mode_wakeup.set()
         
     async def mode_check(self):
-        """Do recount on the users' mode votes and see if a change is necessary.
-        
+        """Long-lived mode check task.
+        Waits for a mode vote, then recounts the users' mode votes every mode_time
+        seconds until no mode change is pending. Expires idle voters in between.
         """
+        
+        while True:
+            timeout = None
+            if self.voters.idle:
+                self.expire_voters()
+                timeout = self.voters.idle / 2
+            try:
+                await asyncio.wait_for(self.mode_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                continue
             
-        self.voters_lock.acquire()
-        result, winner = self.count_voters()
+            print("Mode change check started")
+            while True:
+                await asyncio.sleep(self.mode_time)
+                with self.voters_lock:
+                    result, winner = self.count_voters()
+                    
+                    print("Anarchists:" + str(result[ANARCHY]))
+                    print("Democrats:" + str(result[DEMOCRACY]))
+                    print("Communists:" + str(result[COMMUNISM]))
+                    print("Live democrats:" + str(result[LIVE_DEMOCRACY]))
+                    
+                    if result[winner] != result[self.mode]:
+                        self.set_mode(winner)
+                            
+                    self.update_info()
+                
+                if self.mode_change == NO_CHANGE:
+                    break
+                print("Mode rechecking timer running...")
+            # Votes during the check were counted by it
+            self.mode_wakeup.clear()
+    
+    
+    def start_mode_check(self):
+        """Start the mode check task unless already running"""
         
-        print("Anarchists:" + str(result[ANARCHY]))
-        print("Democrats:" + str(result[DEMOCRACY]))
-        print("Communists:" + str(result[COMMUNISM]))
+        if self.mode_task is None:
+            self.mode_task = self.loop.create_task(self.mode_check())
+    
+    
+    def expire_voters(self):
+        """Remove voters idle for longer than voter_idle seconds"""
         
-        if result[winner] != result[self.mode]:
-            self.set_mode(winner)
-            self.mode_timer = False
-                
-        self.update_info()
-        self.voters_lock.release()
-
-        if self.mode_change != NO_CHANGE:
-            self.mode_timer = True
-            print("Mode rechecking timer running...")
-            await asyncio.sleep(self.mode_time)
-            await self.mode_check()
-        else:
-            self.mode_timer = False
+        with self.voters_lock:
+            expired = self.voters.expire()
+            for user in expired:
+                self.record(journal.VOTER, user, None)
+        if expired:
+            self.update_info()
         
             
     def set_mode(self, mode):
@@ -397,19 +853,27 @@ class CanalBot(commands.Bot):
         if self.mode_change == mode:         
             self.mode = mode
             self.fw_log.queue("Mode change\n")
-            self.fw_vinfo.clear()
 
             if self.mode == ANARCHY:
-                self.fw_vinfo.queue("Anarchy active, anything goes")
+                self.fw_vinfo.set("Anarchy active, anything goes")
             elif self.mode == DEMOCRACY:
-                self.fw_vinfo.queue("Democracy rules supreme")
+                self.fw_vinfo.set("Democracy rules supreme")
             elif self.mode == COMMUNISM:
-                self.fw_vinfo.queue("Welcome to communism, comrade")
-                self.fw_vinfo.queue(f"Communist Comrades' Command Plan active\n")
+                self.fw_vinfo.set("Welcome to communism, comrade\n"
+                                  "Communist Comrades' Command Plan active\n")
+            elif self.mode == LIVE_DEMOCRACY:
+                self.fw_vinfo.set("Live democracy, the crowd steers")
             self.mode_change = NO_CHANGE
+            self.publish(voting = False, leader = None, winner = None, plan = None, plan_step = None)
 
-            if mode != COMMUNISM:
+            if mode == LIVE_DEMOCRACY:
+                self.joy.set_normal_mode()
+                self.record(journal.CLEAR_SEQUENCES)
+                self.init_live_vote()
+                self.start_live()
+            elif mode != COMMUNISM:
                 self.joy.set_normal_mode()
+                self.record(journal.CLEAR_SEQUENCES)
                 self.init_democratic_vote()
             else:
                 self.joy.set_sequential_mode()
@@ -420,37 +884,37 @@ class CanalBot(commands.Bot):
                 self.mode_change = NO_CHANGE
             else:
                 self.mode_change = mode
+        self.record(journal.MODE, self.mode, self.mode_change)
         
             
     
-    def get_mode(self):
-        """Return current mode in string"""
+    def get_mode(self, mode = None):
+        """Return current or given mode in string, None for NO_CHANGE"""
         
-        if self.mode == DEMOCRACY:
+        if mode is None:
+            mode = self.mode
+        if mode == DEMOCRACY:
             return "Democracy"
-        elif self.mode == ANARCHY:
+        elif mode == ANARCHY:
             return "Anarchy"
-        elif self.mode == COMMUNISM:
+        elif mode == COMMUNISM:
             return "Communism"
+        elif mode == LIVE_DEMOCRACY:
+            return "Live democracy"
         
     
     def count_voters(self):
         """Helper function to calculate numbers of anarchist/democrat voters"""
         
-        result = [0,0,0]
+        # Indexed by mode, NO_VOTE slot counts users who have not voted
+        result = list(self.voters.counts)
         winner = 0
-        for i in self.voters.values():
-            if i == ANARCHY:
-                result[ANARCHY] += 1
-            elif i == DEMOCRACY:
-                result[DEMOCRACY] += 1
-            elif i == COMMUNISM:
-                result[COMMUNISM] += 1
-                
         if result[COMMUNISM] > result[winner]:
             winner = COMMUNISM
         if result[DEMOCRACY] > result[winner]:
             winner = DEMOCRACY
+        if result[LIVE_DEMOCRACY] > result[winner]:
+            winner = LIVE_DEMOCRACY
                
         return result, winner
         
@@ -463,9 +927,11 @@ class CanalBot(commands.Bot):
         anarchists = str(result[ANARCHY])
         democrats = str(result[DEMOCRACY])
         communists = str(result[COMMUNISM])
+        live = str(result[LIVE_DEMOCRACY])
         
         status1 = f"Mode: {self.get_mode()}."
-        status2 = f"Democrats : {democrats} -  Anarchists : {anarchists} - Communists : {communists}"
+        status2 = (f"Democrats : {democrats} -  Anarchists : {anarchists} - Communists : {communists}"
+                   f" - Live democrats : {live}")
         change = ""
         if self.mode_change == ANARCHY:
             change += "Moving to anarchy!"
@@ -473,18 +939,50 @@ class CanalBot(commands.Bot):
             change += "Moving to democracy!"
         elif self.mode_change == COMMUNISM:
             change += "Moving to communism!"
+        elif self.mode_change == LIVE_DEMOCRACY:
+            change += "Moving to live democracy!"
         
-        self.fw_info.clear()
-        self.fw_info.queue(status1 + "\n" + status2 + "\n" + change)
+        self.fw_info.set(status1 + "\n" + status2 + "\n" + change)
+        self.publish(mode = self.get_mode(), mode_change = self.get_mode(self.mode_change),
+                     voters = {"anarchy": result[ANARCHY], "democracy": result[DEMOCRACY],
+                               "communism": result[COMMUNISM], "live": result[LIVE_DEMOCRACY]})
+
+
+    def shutdown(self):
+        """Stop the chat sender, mode check and live ticks, flush and close the file writers"""
+        
+        self.chat.close()
+        if self.controller_process:
+            self.joy.close()
+        if self.mode_task is not None:
+            self.mode_task.cancel()
+        if self.live_task is not None:
+            self.live_task.cancel()
+        if self.feed is not None:
+            self.feed.close()
+        if self.watcher is not None:
+            self.watcher.stop()
+        writers = [self.fw_info, self.fw_vinfo, self.fw_log]
+        if self.event_log is not None:
+            writers.append(self.event_log)
+        if self.journal is not None:
+            writers.append(self.journal)
+        for writer in writers:
+            writer.closefile()
+        for writer in writers:
+            if isinstance(writer, threading.Thread):
+                writer.join(1)
 
 
     def get_cmd_utf(self, command):
-        if command in self.cmd_utf:
-            return self.cmd_utf[command]
-        else:
-            return command
+        """Return display glyph of the given command id"""
+        
+        return self.compiled.table.glyphs[command]
         
 
 if __name__ == "__main__":
   canalbot = CanalBot("config.json")
-  canalbot.run()
+  try:
+    canalbot.run()
+  finally:
+    canalbot.shutdown()
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+# Twitch allows 20 messages per 30 seconds for regular accounts. Burst plus
+# refill over any 30 second window stays within that.
+CHAT_RATE = 0.6
+CHAT_BURST = 2
+
+
+class chatsender:
+    """Outbound chat queue sent from a single task on the bot's loop.
+
+    send() only queues the message, so callers never wait on the network.
+    Sends are paced by a token bucket of rate messages per second.
+    Messages queued with the same key supersede each other: if an earlier
+    message with the key has not been sent yet, it is dropped.
+    """
+
+    def __init__(self, loop, rate = CHAT_RATE, burst = CHAT_BURST):
+        self.loop = loop
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        # key -> (channel, message), sent in order of queueing
+        self.pending = OrderedDict()
+        self.serial = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+        # Statistics
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+
+
+    def send(self, channel, message, key = None):
+        """Queue message to channel. Replaces an unsent message with the same key"""
+
+        if key is None:
+            self.serial += 1
+            key = self.serial
+        else:
+            key = (channel.name, key)
+            if self.pending.pop(key, None) is not None:
+                self.merged += 1
+        self.pending[key] = (channel, message)
+        if self.task is None:
+            self.task = self.loop.create_task(self.__run())
+        self.wakeup.set()
+
+
+    def drop(self, channel, key):
+        """Discard an unsent message queued with key"""
+
+        if self.pending.pop((channel.name, key), None) is not None:
+            self.merged += 1
+
+
+    async def __take(self):
+        """Wait until a send token is available and take it"""
+
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+    async def __run(self):
+        while True:
+            while not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            # Superseding messages may arrive while waiting for the token
+            await self.__take()
+            if not self.pending:
+                # Token is not used, give it back
+                self.tokens += 1
+                continue
+            _, (channel, message) = self.pending.popitem(last = False)
+            try:
+                await channel.send(message)
+            except Exception as e:
+                self.failed += 1
+                print(f"Chat send failed: {e}")
+            else:
+                self.sent += 1
+
+
+    def close(self):
+        """Stop sending. Unsent messages are discarded"""
+
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+    def __len__(self):
+        return len(self.pending)
@@ -0,0 +1,184 @@
+import re
+
+# Parse results
+MODE_VOTE = 1
+COMMANDS = 2
+PROGRAM = 3
+
+# Default limits for compact syntax, eg. "a3" or "u,u,r"
+MAX_REPEAT = 9
+MAX_COMMANDS = 10
+
+# Default limits for programs, eg. "a+b,r*4,~200,a:800"
+MAX_PROGRAM_STEPS = 32
+MAX_PROGRAM_TIME = 5.0
+
+# Release time between program steps, so repeated taps register as separate presses
+STEP_GAP = 1 / 60
+
+PROGRAM_SYNTAX = "+*:~"
+
+
+class commandtable:
+    """Commands resolved into ids. A command id indexes names, buttons,
+    long press flags, hold times and glyphs, so lookups after parsing are
+    plain tuple indexing.
+
+    Built from a previous table, ids of the previous table stay valid.
+    Commands removed since keep their id and button, so queued commands and
+    votes can still be executed, but are no longer in ids and not parsed.
+    """
+
+    def __init__(self, commands: dict, cmd_utf: dict = None, holdtime = 0.0, holdtime_long = 0.0,
+                 previous = None):
+        if cmd_utf is None:
+            cmd_utf = {}
+        # Glyph keys may be padded to two characters, eg. "u "
+        glyphs = {name.strip(): glyph for name, glyph in cmd_utf.items()}
+        names = list(previous.names) if previous is not None else []
+        known = set(names)
+        names.extend(name for name in commands if name not in known)
+
+        self.names = tuple(names)
+        self.ids = {name: cid for cid, name in enumerate(self.names) if name in commands}
+        self.buttons = tuple(commands[name] if name in commands else previous.buttons[cid]
+                             for cid, name in enumerate(self.names))
+        self.long = tuple(len(name) > 1 for name in self.names)
+        self.holds = tuple(holdtime_long if long else holdtime for long in self.long)
+        self.glyphs = tuple(glyphs.get(name, previous.glyphs[cid] if cid < len(known) else name)
+                            for cid, name in enumerate(self.names))
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+class cmdparser:
+    """Precompiled chat message matcher.
+
+    Messages that can not be commands are rejected by looking at the first
+    characters only. Valid messages are resolved into command ids with
+    repeat counts expanded, eg. "a3" -> [a, a, a] and "u,u,r" -> [u, u, r].
+
+    Messages using chords, repeats, holds or waits are compiled into programs,
+    tuples of (button mask, seconds) steps. A step presses all buttons of the
+    mask at once for the given time, mask 0 is a wait. Steps are separated by
+    commas:
+        a+b     a and b pressed together
+        r*4     r tapped four times
+        a:800   a held for 800 ms
+        ~200    wait 200 ms
+    """
+
+    def __init__(self, table: commandtable, mode_commands: dict, prefix = "",
+                 max_repeat = MAX_REPEAT, max_commands = MAX_COMMANDS,
+                 max_program_steps = MAX_PROGRAM_STEPS, max_program_time = MAX_PROGRAM_TIME):
+        self.table = table
+        self.mode_commands = mode_commands
+        self.prefix = prefix
+        self.max_repeat = max_repeat
+        self.max_commands = max_commands
+        self.max_program_steps = max_program_steps
+        self.max_program_time = max_program_time
+
+        words = list(table.ids) + list(mode_commands)
+        self.first = frozenset(w[0].lower() for w in words) | frozenset(w[0].upper() for w in words)
+        self.first |= frozenset("~")
+
+        # Longest names first so that "uu" is not read as "u"
+        names = "|".join(re.escape(name) for name in sorted(table.ids, key = len, reverse = True))
+        token = f"(?:{names})\\d{{0,{len(str(max_repeat))}}}"
+        self.message_re = re.compile(f"{token}(?:,{token})*")
+        self.token_re = re.compile(f"({names})(\\d*)")
+
+        # Upper bound for message length, anything longer is not a command.
+        # Program steps may be as long as "name+name:holdms,"
+        longest = max(len(w) for w in words)
+        self.max_length = len(prefix) + max(longest, max_commands * (longest + len(str(max_repeat)) + 1),
+                                            max_program_steps * (2 * longest + 8))
+
+
+    def parse(self, message: str):
+        """Parse chat message.
+        Returns None for non-command messages, (MODE_VOTE, mode command) for
+        mode votes and (COMMANDS, list of command ids) for commands.
+        """
+
+        # Fast rejection, no allocations until the message looks like a command
+        if len(message) > self.max_length:
+            return None
+        start = 0
+        if self.prefix:
+            if not message.startswith(self.prefix):
+                return None
+            start = len(self.prefix)
+        while start < len(message) and message[start] == " ":
+            start += 1
+        if start == len(message) or message[start] not in self.first:
+            return None
+
+        content = message[start:].replace(" ", "").lower()
+
+        if content in self.mode_commands:
+            return MODE_VOTE, content
+
+        for c in PROGRAM_SYNTAX:
+            if c in content:
+                program = self.compile_program(content)
+                return None if program is None else (PROGRAM, program)
+
+        if not self.message_re.fullmatch(content):
+            return None
+
+        ids = []
+        lookup = self.table.ids
+        for name, count in self.token_re.findall(content):
+            repeat = int(count) if count else 1
+            if repeat < 1 or repeat > self.max_repeat:
+                return None
+            ids.extend([lookup[name]] * repeat)
+        if len(ids) > self.max_commands:
+            return None
+        return COMMANDS, ids
+
+
+
+    def compile_program(self, content: str):
+        """Compile program text into a tuple of (button mask, seconds) steps.
+        Returns None if the text is invalid or exceeds the step or time limit.
+        """
+
+        table = self.table
+        steps = []
+        total = 0.0
+        for part in content.split(","):
+            if part.startswith("~"):
+                if not part[1:].isdigit():
+                    return None
+                wait = int(part[1:]) / 1000
+                steps.append((0, wait))
+                total += wait
+                continue
+
+            chord, colon, hold = part.partition(":")
+            chord, star, repeat = chord.partition("*")
+            if (colon and not hold.isdigit()) or (star and not repeat.isdigit()):
+                return None
+            mask = 0
+            default = 0.0
+            for name in chord.split("+"):
+                cid = table.ids.get(name)
+                if cid is None:
+                    return None
+                mask |= 1 << table.buttons[cid]
+                default = max(default, table.holds[cid])
+            seconds = int(hold) / 1000 if hold else default
+            repeat = int(repeat) if repeat else 1
+            if seconds <= 0 or repeat < 1 or len(steps) + repeat > self.max_program_steps:
+                return None
+            steps.extend([(mask, seconds)] * repeat)
+            total += repeat * (seconds + STEP_GAP)
+
+        if not any(mask for mask, _ in steps) or total > self.max_program_time:
+            return None
+        return tuple(steps)
@@ -0,0 +1,233 @@
+"""Compact binary log of every command the bot handles.
+
+Each event is a fixed-size 24 byte record: wall clock time, user id, command
+id, mode, outcome and the command's position in a multi-command message.
+User ids index the names in the "<file>.users" sidecar, one name per line,
+id 0 being the bot itself for executed vote results. Command ids are those
+of the command table, which stay valid across config reloads.
+
+Usage:
+    python eventlog.py events.bin [config.json]
+"""
+
+import json
+import os
+import struct
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+
+MAGIC = b"CANALEV2"
+HEADER = struct.Struct("<8sI4x")
+RECORD = struct.Struct("<dIHBBHH4x")
+DTYPE = np.dtype([("time", "<f8"), ("user", "<u4"), ("cmd", "<u2"), ("mode", "u1"),
+                  ("outcome", "u1"), ("step", "<u2"), ("steps", "<u2"), ("pad", "V4")])
+
+# Outcomes
+EXECUTED = 0        # anarchy command sent to the controller
+VOTED = 1           # democracy or live democracy vote counted
+DROPPED = 2         # rate limited, duplicate vote or not valid in the mode
+PLAN = 3            # command of a counted communist plan vote
+MODE_VOTE = 4       # mode vote, cmd is the mode value
+PROGRAM = 5         # anarchy program, cmd is the number of steps
+WON = 6             # vote result executed, user is the bot
+OUTCOMES = ("executed", "voted", "dropped", "plan", "mode vote", "program", "won")
+
+BOT = 0
+
+# Default batch limits, the batch is written when either is reached
+FLUSH_BYTES = 64 * 1024
+FLUSH_INTERVAL = 1.0
+
+
+def users_filename(filename):
+    return filename + ".users"
+
+
+class eventlog:
+    """Batched event log writer on the bot's loop.
+
+    record() packs the event into an in-memory batch. The batch is written
+    with one write once flush_bytes have been collected or flush_interval
+    has passed, the same way aiofilewriter groups its lines. New user names
+    are appended to the users file before the events referring to them.
+    """
+
+    def __init__(self, loop, filename, flush_bytes = FLUSH_BYTES, flush_interval = FLUSH_INTERVAL,
+                 botname = ""):
+        self.loop = loop
+        self.filename = filename
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.batch = bytearray()
+        self.new_users = []
+        self.flush_handle = None
+
+        # Continue the user ids of an existing log
+        self.users = {}
+        try:
+            with open(users_filename(filename), "r", encoding = "utf-8") as f:
+                for uid, line in enumerate(f):
+                    self.users.setdefault(line.rstrip("\n"), uid)
+        except FileNotFoundError:
+            pass
+        if not self.users:
+            self.users[botname] = BOT
+            self.new_users.append(botname)
+
+        self.file = open(filename, "ab")
+        if self.file.tell() == 0:
+            self.file.write(HEADER.pack(MAGIC, RECORD.size))
+        self.users_file = open(users_filename(filename), "a", encoding = "utf-8")
+
+        # Statistics
+        self.events = 0
+        self.flushes = 0
+
+
+    def user_id(self, user):
+        uid = self.users.get(user)
+        if uid is None:
+            uid = self.users[user] = len(self.users)
+            self.new_users.append(user)
+        return uid
+
+
+    def record(self, now, user, mode, outcome, cmd, step = 0, steps = 1):
+        """Add an event to the batch. user is a name, BOT or a user id from user_id()"""
+
+        if not isinstance(user, int):
+            user = self.user_id(user)
+        self.batch += RECORD.pack(now, user, cmd, mode, outcome, step, steps)
+        self.events += 1
+        if len(self.batch) >= self.flush_bytes:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(self.flush_interval, self.flush)
+
+
+    def flush(self):
+        """Write the batch"""
+
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.new_users:
+            self.users_file.write("".join(f"{user}\n" for user in self.new_users))
+            self.users_file.flush()
+            self.new_users = []
+        if self.batch:
+            self.file.write(self.batch)
+            self.file.flush()
+            self.batch = bytearray()
+            self.flushes += 1
+
+
+    def backlog(self):
+        """Return number of recorded, not yet written events"""
+
+        return len(self.batch) // RECORD.size
+
+
+    def closefile(self):
+        self.flush()
+        self.file.close()
+        self.users_file.close()
+
+
+class eventreader:
+    """Memory-mapped event log reader.
+
+    records is a numpy structured array over the file, so whole columns can
+    be filtered and counted without reading the file into memory. A record
+    torn by a crash at the end of the file is ignored.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            magic, size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or size != DTYPE.itemsize:
+            raise ValueError(f"{filename} is not a {DTYPE.itemsize} byte record event log")
+        count = (os.path.getsize(filename) - HEADER.size) // DTYPE.itemsize
+        if count:
+            self.records = np.memmap(filename, dtype = DTYPE, mode = "r",
+                                     offset = HEADER.size, shape = (count,))
+        else:
+            self.records = np.zeros(0, dtype = DTYPE)
+        try:
+            with open(users_filename(filename), "r", encoding = "utf-8") as f:
+                self.users = [line.rstrip("\n") for line in f]
+        except FileNotFoundError:
+            self.users = []
+
+
+    def user(self, uid):
+        return self.users[uid] if uid < len(self.users) else f"user{uid}"
+
+
+    def summary(self):
+        """Return event counts by outcome, mode and command, and the time span"""
+
+        records = self.records
+        if not len(records):
+            return {"events": 0}
+        outcomes = np.bincount(records["outcome"], minlength = len(OUTCOMES))
+        commands = (records["outcome"] == EXECUTED) | (records["outcome"] == WON)
+        return {"events": len(records),
+                "seconds": float(records["time"][-1] - records["time"][0]),
+                "users": len(np.unique(records["user"])),
+                "outcomes": {name: int(outcomes[i]) for i, name in enumerate(OUTCOMES)},
+                "modes": {int(m): int(n) for m, n in enumerate(np.bincount(records["mode"])) if n},
+                "executed": {int(c): int(n) for c, n in
+                             enumerate(np.bincount(records["cmd"][commands])) if n}}
+
+
+    def chat(self, names, mode_names):
+        """Rebuild the chat messages that caused the events, for replaying them into the bot.
+
+        names is the command table's names and mode_names maps mode values to
+        mode commands. Returns a list of (time, user, message). Vote results
+        and programs are not chat input and are skipped.
+        """
+
+        chat = []
+        message = []
+        for now, uid, cmd, mode, outcome, step, steps, _ in self.records.tolist():
+            if outcome == WON or outcome == PROGRAM:
+                continue
+            if outcome == MODE_VOTE:
+                text = mode_names.get(cmd)
+                if text is not None:
+                    chat.append((now, self.user(uid), text))
+                continue
+            message.append(names[cmd])
+            if step + 1 >= steps:
+                chat.append((now, self.user(uid), ",".join(message)))
+                message = []
+        return chat
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    reader = eventreader(sys.argv[1])
+    started = time.perf_counter()
+    summary = reader.summary()
+    elapsed = time.perf_counter() - started
+
+    names = None
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "r") as cfg:
+            names = list(json.load(cfg)["commands"])
+    executed = summary.pop("executed", {})
+    print(json.dumps(summary, indent = 2))
+    top = Counter({(names[c] if names and c < len(names) else c): n for c, n in executed.items()})
+    print("Most executed:", ", ".join(f"{c} {n}" for c, n in top.most_common(10)))
+    print(f"Scanned in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
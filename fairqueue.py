@@ -0,0 +1,195 @@
+from collections import OrderedDict, deque
+
+
+class fairqueue:
+    """Queue with one subqueue per user, popped round-robin across users.
+    A single heavy user can only delay others by one item per round.
+    """
+
+    def __init__(self):
+        # user -> deque of items, in round-robin order
+        self.lanes = OrderedDict()
+        self.length = 0
+
+
+    def append(self, item, user = None):
+        lane = self.lanes.get(user)
+        if lane is None:
+            lane = self.lanes[user] = deque()
+        lane.append(item)
+        self.length += 1
+
+
+    def popleft(self):
+        """Pop the next item of the user whose turn it is"""
+
+        user, lane = next(iter(self.lanes.items()))
+        item = lane.popleft()
+        if lane:
+            self.lanes.move_to_end(user)
+        else:
+            del self.lanes[user]
+        self.length -= 1
+        return item
+
+
+    def lane(self, user):
+        """Return the subqueue of the given user or None"""
+
+        return self.lanes.get(user)
+
+
+    def longest(self):
+        """Return the user with most queued items"""
+
+        return max(self.lanes, key = lambda user: len(self.lanes[user]))
+
+
+    def drop(self, user):
+        """Drop the oldest item of given user"""
+
+        lane = self.lanes[user]
+        lane.popleft()
+        if not lane:
+            del self.lanes[user]
+        self.length -= 1
+
+
+    def compact(self, user):
+        """Merge consecutive identical items of given user. Returns number of merged items"""
+
+        lane = self.lanes[user]
+        merged = deque()
+        for item in lane:
+            if not merged or merged[-1] != item:
+                merged.append(item)
+        removed = len(lane) - len(merged)
+        self.lanes[user] = merged
+        self.length -= removed
+        return removed
+
+
+    def clear(self):
+        self.lanes.clear()
+        self.length = 0
+
+
+    def __iter__(self):
+        for lane in self.lanes.values():
+            yield from lane
+
+
+    def __len__(self):
+        return self.length
+
+
+# Priority levels, higher is served first
+PRIORITY_CHAT = 0
+PRIORITY_MOD = 1
+PRIORITY_STREAMER = 2
+PRIORITY_LEVELS = 3
+
+# Consecutive items served from higher levels while a lower one waits
+PRIORITY_BURST = 4
+
+
+class priorityqueue:
+    """fairqueue per priority level. The highest non-empty level is served
+    first, but after burst consecutive items from higher levels a waiting
+    lower level gets one item, so it cannot starve. Each waiting lower level
+    has its own count, so a high priority item waits for at most levels - 1
+    lower items per burst of its own level.
+    Users are keyed by (priority, user) in longest, drop and compact.
+    """
+
+    def __init__(self, levels = PRIORITY_LEVELS, burst = PRIORITY_BURST):
+        self.levels = [fairqueue() for _ in range(levels)]
+        self.burst = burst
+        # Items served in a row while a lower level was waiting, per level
+        self.served = [0] * levels
+        self.length = 0
+
+
+    def append(self, item, user = None, priority = PRIORITY_CHAT):
+        self.levels[priority].append(item, user)
+        self.length += 1
+
+
+    def popleft(self):
+        """Pop from the highest level with items, unless a lower waiting level is due"""
+
+        top = None
+        for priority in range(len(self.levels) - 1, -1, -1):
+            if not self.levels[priority]:
+                continue
+            if top is None:
+                top = priority
+            elif self.served[priority] >= self.burst:
+                # Lower level waited a full burst, it gets this turn
+                self.served[priority] = 0
+                self.length -= 1
+                return self.levels[priority].popleft()
+            else:
+                self.served[priority] += 1
+        # Levels below top that are empty start over
+        for priority in range(top):
+            if not self.levels[priority]:
+                self.served[priority] = 0
+        self.served[top] = 0
+        self.length -= 1
+        return self.levels[top].popleft()
+
+
+    def lane(self, user, priority = PRIORITY_CHAT):
+        """Return the subqueue of the given user at priority or None"""
+
+        return self.levels[priority].lane(user)
+
+
+    def lowest(self):
+        """Return the lowest priority with items, None if empty"""
+
+        for priority, level in enumerate(self.levels):
+            if level:
+                return priority
+        return None
+
+
+    def longest(self):
+        """Return (priority, user) of the user with most queued items at the lowest priority"""
+
+        priority = self.lowest()
+        return priority, self.levels[priority].longest()
+
+
+    def drop(self, key):
+        """Drop the oldest item of given (priority, user)"""
+
+        priority, user = key
+        self.levels[priority].drop(user)
+        self.length -= 1
+
+
+    def compact(self, key):
+        """Merge consecutive identical items of given (priority, user). Returns number of merged items"""
+
+        priority, user = key
+        removed = self.levels[priority].compact(user)
+        self.length -= removed
+        return removed
+
+
+    def clear(self):
+        for level in self.levels:
+            level.clear()
+        self.served = [0] * len(self.levels)
+        self.length = 0
+
+
+    def __iter__(self):
+        for level in reversed(self.levels):
+            yield from level
+
+
+    def __len__(self):
+        return self.length
@@ -1,53 +1,144 @@
+import os
 import time
 import threading
 
+# Group commit defaults. Buffered data is flushed when either is reached.
+FLUSH_BYTES = 64 * 1024
+FLUSH_INTERVAL = 1.0
+
+
+def rotated_name(filename):
+    """Return an unused timestamped name for rotating the given file"""
+
+    base, ext = os.path.splitext(filename)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    target = f"{base}-{stamp}{ext}"
+    n = 0
+    while os.path.exists(target):
+        n += 1
+        target = f"{base}-{stamp}-{n}{ext}"
+    return target
+
 
 class filewriter(threading.Thread):
-    
-    def __init__(self, file, mode):
+    """File writer thread.
+
+    In append mode ("a") every queued line is written and flushed as a group
+    once FLUSH_BYTES are buffered or FLUSH_INTERVAL has passed, whichever comes
+    first. The file can be rotated by size and/or date.
+    In write mode ("w") only the latest queued data is written, immediately.
+    """
+
+    def __init__(self, file, mode, flush_bytes = FLUSH_BYTES, flush_interval = FLUSH_INTERVAL,
+                 rotate_bytes = 0, rotate_daily = False):
         threading.Thread.__init__(self)
         self.filename = file
         self.file = ""
         self.mode = mode
         self.close = False
         self.condition = threading.Condition()
+        self.file_lock = threading.Lock()
         self.data = []
 
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        self.opened_day = None
+
+        # Write statistics
+        self.started = time.monotonic()
+        self.lines = 0
+        self.written = 0
+        self.flushes = 0
+        self.rotations = 0
+
+
+    def __open(self):
+        buffering = self.flush_bytes if "a" in self.mode else -1
+        self.file = open(self.filename, self.mode, encoding="utf-8", buffering=buffering)
+        self.opened_day = time.strftime("%Y%m%d")
+
 
     def run(self):
         if self.mode != "r":
             try:
-                self.file = open(self.filename, self.mode, encoding="utf-8")
+                self.__open()
             except FileNotFoundError:
                 print(f"Error -  File \"{self.filename}\" not found.\nExiting.")
                 return
         else:
             print("Read only mode given, exiting.")
-        
-        while not self.close:
+            return
+
+        append = "a" in self.mode
+        unflushed = 0
+        last_flush = time.monotonic()
+        while True:
             with self.condition:
-                while not self.data:
-                    if self.close:
+                while not self.data and not self.close:
+                    if not unflushed:
+                        self.condition.wait()
+                        continue
+                    remaining = last_flush + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
                         break
-                    self.condition.wait()
-                if type != "a":
-                    if self.data:
-                        self.file.write(self.data.pop())
-                        self.data = []
-                else:                
-                    while self.data:
-                        self.file.write(self.data.pop(0))
-            self.file.flush()
+                    self.condition.wait(remaining)
+                data = self.data
+                self.data = []
+                closing = self.close
+
+            with self.file_lock:
+                if append:
+                    if data:
+                        text = "".join(data)
+                        self.file.write(text)
+                        self.lines += len(data)
+                        self.written += len(text)
+                        unflushed += len(text)
+                    now = time.monotonic()
+                    if unflushed and (closing or unflushed >= self.flush_bytes
+                                      or now - last_flush >= self.flush_interval):
+                        self.file.flush()
+                        self.flushes += 1
+                        unflushed = 0
+                        last_flush = now
+                        self.__check_rotate()
+                elif data:
+                    self.file.write(data[-1])
+                    self.file.flush()
+                    self.lines += 1
+                    self.written += len(data[-1])
+                    self.flushes += 1
+
+            if closing:
+                break
         self.file.close()
 
 
+    def __check_rotate(self):
+        """Rotate the file if size or date limit has been reached.
+        Ensure that you have acquired the file_lock as this is not done here!
+        """
+
+        day = time.strftime("%Y%m%d")
+        if ((self.rotate_bytes and self.file.tell() >= self.rotate_bytes)
+            or (self.rotate_daily and day != self.opened_day)):
+            self.file.close()
+            os.replace(self.filename, rotated_name(self.filename))
+            self.rotations += 1
+            self.__open()
+
+
     def clear(self):
-        with self.condition:
+        with self.condition, self.file_lock:
+            self.data = []
+            if not self.file:
+                return
             self.file.seek(0)
             self.file.truncate()
-            self.data = []
-        
-    
+
+
     def queue(self, data):
         if not self.close:
             with self.condition:
@@ -55,10 +146,274 @@ class filewriter(threading.Thread):
                 self.condition.notify()
         else:
             print("File already closing")
-            
+
 
     def closefile(self):
+        """Flush everything queued so far and close the file"""
+
         self.close = True
         with self.condition:
             self.condition.notify()
-    
+
+
+    def backlog(self):
+        """Return number of queued, not yet written items"""
+
+        return len(self.data)
+
+
+    def stats(self):
+        """Return written lines, characters, flushes and lines per second"""
+
+        elapsed = time.monotonic() - self.started
+        rate = self.lines / elapsed if elapsed > 0 else 0.0
+        return self.lines, self.written, self.flushes, rate
+
+
+# Default maximum overlay file update rate
+OVERLAY_FPS = 10
+
+
+def publish(tempname, filename, text):
+    """Write text to tempname and atomically replace filename with it"""
+
+    with open(tempname, "w", encoding="utf-8") as tmp:
+        tmp.write(text)
+    os.replace(tempname, filename)
+
+
+class overlaywriter(threading.Thread):
+    """Overlay text file publisher.
+
+    The latest text given with set() is written at most fps times per second
+    and skipped if unchanged. Files are written to a temporary file and
+    renamed over the target, so readers never see a truncated file.
+    """
+
+    def __init__(self, file, fps = OVERLAY_FPS):
+        threading.Thread.__init__(self)
+        self.filename = file
+        self.tempname = file + ".tmp"
+        self.interval = 1 / fps
+        self.close = False
+        self.condition = threading.Condition()
+        self.text = None
+        self.published = None
+
+        # Write statistics
+        self.writes = 0
+        self.skipped = 0
+
+
+    def run(self):
+        last_write = 0.0
+        while True:
+            with self.condition:
+                while self.text == self.published and not self.close:
+                    self.condition.wait()
+                closing = self.close
+
+            # Let updates accumulate until the next frame
+            delay = last_write + self.interval - time.monotonic()
+            if delay > 0 and not closing:
+                time.sleep(delay)
+
+            with self.condition:
+                text = self.text
+            if text is not None and text != self.published:
+                try:
+                    self.__publish(text)
+                except OSError as e:
+                    # Target may be held open by a reader on Windows, retry next frame
+                    print(f"Overlay write to \"{self.filename}\" failed: {e}")
+                else:
+                    self.published = text
+                    self.writes += 1
+                last_write = time.monotonic()
+
+            if closing:
+                break
+
+
+    def __publish(self, text):
+        publish(self.tempname, self.filename, text)
+
+
+    def set(self, text):
+        """Set the overlay text. Unchanged text is not rewritten"""
+
+        with self.condition:
+            if text == self.text:
+                self.skipped += 1
+                return
+            self.text = text
+            self.condition.notify()
+
+
+    def closefile(self):
+        """Write the latest text and stop"""
+
+        self.close = True
+        with self.condition:
+            self.condition.notify()
+
+
+    def backlog(self):
+        """Return 1 if there is unpublished text"""
+
+        return int(self.text != self.published)
+
+
+class aiofilewriter:
+    """Asyncio version of the append mode filewriter, running on the given loop.
+
+    Queued lines go straight into the file object's flush_bytes sized buffer,
+    which only reaches the OS when full, and a loop.call_later timer flushes
+    it every flush_interval. No thread or lock is involved.
+    """
+
+    def __init__(self, loop, file, mode, flush_bytes = FLUSH_BYTES, flush_interval = FLUSH_INTERVAL,
+                 rotate_bytes = 0, rotate_daily = False):
+        self.loop = loop
+        self.filename = file
+        self.file = None
+        self.mode = mode
+        self.close = False
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        self.opened_day = None
+        self.flush_handle = None
+
+        # Write statistics
+        self.started = time.monotonic()
+        self.lines = 0
+        self.written = 0
+        self.flushes = 0
+        self.rotations = 0
+
+
+    def start(self):
+        """Open the file"""
+
+        self.file = open(self.filename, self.mode, encoding="utf-8", buffering=self.flush_bytes)
+        self.opened_day = time.strftime("%Y%m%d")
+
+
+    def queue(self, data):
+        if self.close or self.file is None:
+            print("File not open")
+            return
+        self.file.write(data)
+        self.lines += 1
+        self.written += len(data)
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(self.flush_interval, self.flush)
+
+
+    def flush(self):
+        """Flush buffered lines and rotate the file if needed"""
+
+        self.flush_handle = None
+        self.file.flush()
+        self.flushes += 1
+        day = time.strftime("%Y%m%d")
+        if ((self.rotate_bytes and self.file.tell() >= self.rotate_bytes)
+            or (self.rotate_daily and day != self.opened_day)):
+            self.file.close()
+            os.replace(self.filename, rotated_name(self.filename))
+            self.rotations += 1
+            self.start()
+
+
+    def closefile(self):
+        """Flush and close the file"""
+
+        self.close = True
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.file is not None:
+            self.file.flush()
+            self.file.close()
+
+
+    def backlog(self):
+        return 0
+
+
+    def stats(self):
+        """Return written lines, characters, flushes and lines per second"""
+
+        elapsed = time.monotonic() - self.started
+        rate = self.lines / elapsed if elapsed > 0 else 0.0
+        return self.lines, self.written, self.flushes, rate
+
+
+class aiooverlaywriter:
+    """Asyncio version of overlaywriter, publishing from loop.call_at timers"""
+
+    def __init__(self, loop, file, fps = OVERLAY_FPS):
+        self.loop = loop
+        self.filename = file
+        self.tempname = file + ".tmp"
+        self.interval = 1 / fps
+        self.text = None
+        self.published = None
+        self.last_write = 0.0
+        self.publish_handle = None
+
+        # Write statistics
+        self.writes = 0
+        self.skipped = 0
+
+
+    def start(self):
+        """Nothing to start, kept for overlaywriter compatibility"""
+
+
+    def set(self, text):
+        """Set the overlay text. Unchanged text is not rewritten"""
+
+        if text == self.text:
+            self.skipped += 1
+            return
+        self.text = text
+        if self.publish_handle is None:
+            deadline = max(time.monotonic(), self.last_write + self.interval)
+            self.publish_handle = self.loop.call_at(deadline, self.__publish)
+
+
+    def __publish(self):
+        self.publish_handle = None
+        text = self.text
+        if text == self.published:
+            return
+        try:
+            publish(self.tempname, self.filename, text)
+        except OSError as e:
+            # Target may be held open by a reader on Windows, retry next frame
+            print(f"Overlay write to \"{self.filename}\" failed: {e}")
+            self.publish_handle = self.loop.call_later(self.interval, self.__publish)
+        else:
+            self.published = text
+            self.writes += 1
+        self.last_write = time.monotonic()
+
+
+    def closefile(self):
+        """Write the latest text and stop"""
+
+        if self.publish_handle is not None:
+            self.publish_handle.cancel()
+            self.publish_handle = None
+        if self.text is not None and self.text != self.published:
+            publish(self.tempname, self.filename, self.text)
+            self.published = self.text
+
+
+    def backlog(self):
+        """Return 1 if there is unpublished text"""
+
+        return int(self.text != self.published)
@@ -0,0 +1,124 @@
+import json
+import os
+from collections import namedtuple
+
+import cmdparser
+
+# Default config file modification check interval in seconds
+RELOAD_INTERVAL = 1.0
+
+# Everything that can change without restarting the bot. Immutable, a reload
+# builds a new one and swaps it in with a single assignment.
+compiledconfig = namedtuple("compiledconfig", ("table", "parser", "mode_commands",
+                                               "vote_time", "mode_time", "plan_size",
+                                               "live_tick", "live_halflife", "live_min_share",
+                                               "live_min_weight"))
+
+# Live democracy defaults: execute every tick, vote halflife in seconds,
+# minimum share of the decayed votes and minimum decayed vote count of the leader
+LIVE_TICK = 0.5
+LIVE_HALFLIFE = 2.0
+LIVE_MIN_SHARE = 0.4
+LIVE_MIN_WEIGHT = 0.5
+
+
+def positive(config, key, default = None):
+    value = config[key] if default is None else config.get(key, default)
+    if not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError(f"{key} must be a positive number")
+    return value
+
+
+def compile_config(config, buttons, previous = None):
+    """Validate config and compile the reloadable parts into lookup tables.
+    Command ids of the previous compiledconfig stay valid in the new one.
+    Raises ValueError if the config is invalid.
+    """
+
+    try:
+        commands = config["commands"]
+        if not isinstance(commands, dict) or not commands:
+            raise ValueError("commands must be a non-empty object")
+        for name, button in commands.items():
+            if not name or "," in name or " " in name:
+                raise ValueError(f"Invalid command name \"{name}\"")
+            if not isinstance(button, int) or not 0 <= button < buttons:
+                raise ValueError(f"Command \"{name}\" button must be 0-{buttons - 1}")
+
+        mode_commands = config["mode_commands"]
+        for name, mode in mode_commands.items():
+            if mode not in (0, 1, 2, 4):
+                raise ValueError(f"Mode command \"{name}\" must be 0, 1, 2 or 4")
+            if name in commands:
+                raise ValueError(f"\"{name}\" is both a command and a mode command")
+
+        vote_time = tuple(config["vote_time"])
+        if len(vote_time) != 2 or any(not isinstance(t, (int, float)) or t < 0 for t in vote_time):
+            raise ValueError("vote_time must be two non-negative numbers")
+        plan_size = config["plan_size"]
+        if not isinstance(plan_size, int) or plan_size < 1:
+            raise ValueError("plan_size must be a positive integer")
+
+        table = cmdparser.commandtable(commands, config.get("cmd_utf"),
+                                       positive(config, "holdtime"),
+                                       positive(config, "holdtime_long"),
+                                       previous.table if previous is not None else None)
+        parser = cmdparser.cmdparser(table, mode_commands, config["bot_prefix"],
+                                     config.get("max_repeat", cmdparser.MAX_REPEAT),
+                                     max(config.get("max_commands", cmdparser.MAX_COMMANDS),
+                                         plan_size),
+                                     config.get("max_program_steps", cmdparser.MAX_PROGRAM_STEPS),
+                                     config.get("max_program_time", cmdparser.MAX_PROGRAM_TIME))
+        live_min_share = positive(config, "live_min_share", LIVE_MIN_SHARE)
+        if live_min_share > 1:
+            raise ValueError("live_min_share must be at most 1")
+        return compiledconfig(table, parser, dict(mode_commands), vote_time,
+                              positive(config, "mode_time"), plan_size,
+                              positive(config, "live_tick", LIVE_TICK),
+                              positive(config, "live_halflife", LIVE_HALFLIFE),
+                              live_min_share,
+                              positive(config, "live_min_weight", LIVE_MIN_WEIGHT))
+    except KeyError as e:
+        raise ValueError(f"Missing config key {e}")
+
+
+class configwatcher:
+    """Polls the config file modification time on the loop.
+    callback is called with the reloaded config dict when the file changes.
+    """
+
+    def __init__(self, loop, filename, callback, interval = RELOAD_INTERVAL):
+        self.loop = loop
+        self.filename = filename
+        self.callback = callback
+        self.interval = interval
+        self.mtime = os.stat(filename).st_mtime_ns
+        self.handle = None
+
+
+    def start(self):
+        self.handle = self.loop.call_later(self.interval, self.__check)
+
+
+    def __check(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except OSError:
+            mtime = self.mtime
+        if mtime != self.mtime:
+            self.mtime = mtime
+            try:
+                with open(self.filename, "r") as cfg:
+                    config = json.load(cfg)
+            except (OSError, ValueError) as e:
+                # Possibly caught mid-save, the next save triggers a new attempt
+                print(f"Config reload failed: {e}")
+            else:
+                self.callback(config)
+        self.handle = self.loop.call_later(self.interval, self.__check)
+
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
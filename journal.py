@@ -0,0 +1,205 @@
+import os
+import pickle
+import threading
+import time
+from collections import deque
+
+import votes
+
+# Journal event types
+MODE = 0            # (mode, mode_change)
+VOTER = 1           # (user, mode vote), None when the user left
+VOTE = 2            # (user, command id)
+PLAN = 3            # (user, plan)
+ROUND = 4           # (plan_size,) new empty round, plan_size 0 for democracy
+SEQUENCE = 5        # (plan,) queued to the controller
+SEQUENCE_START = 6  # () controller started the oldest queued sequence
+CLEAR_SEQUENCES = 7 # () queued sequences dropped
+TABLE = 8           # (names,) command table grown by a config reload
+
+# Defaults for write interval and snapshot compaction
+JOURNAL_INTERVAL = 0.5
+SNAPSHOT_INTERVAL = 60.0
+SNAPSHOT_EVENTS = 10000
+
+
+class state:
+    """Restorable bot state, rebuilt by applying journal events"""
+
+    def __init__(self, names):
+        # Command names by id, votes are only valid for the same table
+        self.names = tuple(names)
+        self.size = len(self.names)
+        self.serial = 0
+        self.mode = None
+        self.mode_change = None
+        self.voters = dict()
+        self.votes = None
+        self.sequences = []
+
+
+    def apply(self, serial, kind, args):
+        """Apply a journal event. Events already in the state are skipped"""
+
+        if serial <= self.serial:
+            return
+        self.serial = serial
+        if kind == MODE:
+            self.mode, self.mode_change = args
+        elif kind == VOTER:
+            user, value = args
+            if value is None:
+                self.voters.pop(user, None)
+            else:
+                self.voters[user] = value
+        elif kind == VOTE or kind == PLAN:
+            if self.votes is not None:
+                self.votes.vote(*args)
+        elif kind == ROUND:
+            plan_size = args[0]
+            if plan_size:
+                self.votes = votes.planround(plan_size, self.size)
+            else:
+                self.votes = votes.voteround(self.size)
+        elif kind == SEQUENCE:
+            self.sequences.append(args[0])
+        elif kind == SEQUENCE_START:
+            if self.sequences:
+                self.sequences.pop(0)
+        elif kind == CLEAR_SEQUENCES:
+            self.sequences.clear()
+        elif kind == TABLE:
+            self.names = tuple(args[0])
+            self.size = len(self.names)
+            if self.votes is not None:
+                self.votes.resize(self.size)
+
+
+def read_events(filename):
+    """Yield (serial, kind, args) from a journal file, stopping at a torn last record"""
+
+    try:
+        f = open(filename, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                return
+
+
+def load(snapshot_file, journal_file, names):
+    """Return the state from snapshot and journal, None if there is neither"""
+
+    try:
+        with open(snapshot_file, "rb") as f:
+            restored = pickle.load(f)
+    except FileNotFoundError:
+        restored = None
+    for serial, kind, args in read_events(journal_file):
+        if restored is None:
+            restored = state(names)
+        restored.apply(serial, kind, args)
+    return restored
+
+
+class journal(threading.Thread):
+    """Append-only state journal with periodic snapshot compaction.
+
+    record() only appends to a deque, all pickling and file writes happen on
+    this thread every interval seconds. The thread keeps its own copy of the
+    state by applying the events it writes. Every snapshot_interval seconds
+    or snapshot_events events the copy is written as a snapshot, replacing
+    the old one atomically, and the journal is truncated.
+    """
+
+    def __init__(self, journal_file, snapshot_file, restored, interval = JOURNAL_INTERVAL,
+                 snapshot_interval = SNAPSHOT_INTERVAL, snapshot_events = SNAPSHOT_EVENTS):
+        threading.Thread.__init__(self)
+        self.journal_file = journal_file
+        self.snapshot_file = snapshot_file
+        self.state = restored
+        self.serial = restored.serial
+        self.interval = interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_events = snapshot_events
+        self.events = deque()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+        # Statistics
+        self.written = 0
+        self.snapshots = 0
+
+
+    def record(self, kind, *args):
+        """Queue a state event. Safe to call from any thread or the event loop"""
+
+        with self.lock:
+            self.serial += 1
+            self.events.append((self.serial, kind, args))
+
+
+    def run(self):
+        # Start from a fresh snapshot, a torn record at the end of the old
+        # journal would hide everything appended after it. Events recorded
+        # before the thread started belong in it, or a crash before the
+        # first write would leave a snapshot without a mode
+        while self.events:
+            self.state.apply(*self.events.popleft())
+        self.__snapshot()
+        file = open(self.journal_file, "wb")
+        since_snapshot = 0
+        last_snapshot = time.monotonic()
+        while True:
+            closing = self.stop.wait(self.interval)
+            written = 0
+            while self.events:
+                event = self.events.popleft()
+                pickle.dump(event, file, pickle.HIGHEST_PROTOCOL)
+                self.state.apply(*event)
+                written += 1
+            if written:
+                file.flush()
+                self.written += written
+                since_snapshot += written
+
+            if since_snapshot and (closing or since_snapshot >= self.snapshot_events
+                                   or time.monotonic() - last_snapshot >= self.snapshot_interval):
+                file.close()
+                self.__snapshot()
+                file = open(self.journal_file, "wb")
+                since_snapshot = 0
+                last_snapshot = time.monotonic()
+
+            if closing:
+                break
+        file.close()
+
+
+    def __snapshot(self):
+        """Write the state snapshot. Journal events up to its serial number are
+        skipped when restoring, so a crash before the journal is truncated is harmless.
+        """
+
+        tempname = self.snapshot_file + ".tmp"
+        with open(tempname, "wb") as f:
+            pickle.dump(self.state, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tempname, self.snapshot_file)
+        self.snapshots += 1
+
+
+    def backlog(self):
+        """Return number of recorded, not yet written events"""
+
+        return len(self.events)
+
+
+    def closefile(self):
+        """Write remaining events, snapshot and stop"""
+
+        self.stop.set()
@@ -0,0 +1,155 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from filewriter import publish
+
+COUNTER = "counter"
+GAUGE = "gauge"
+SUMMARY = "summary"
+
+
+class counter:
+    """Monotonic counter. inc() is a plain attribute add, cheap enough for the message hot path"""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+
+class summary:
+    """Count, sum and max of observed values"""
+
+    __slots__ = ("count", "sum", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+
+class registry:
+    """Metrics registry, rendered in Prometheus text format.
+
+    Counters and summaries are updated in place by the owner. Gauges and
+    counters kept elsewhere (eg. controller drop counts) are registered as
+    functions and only evaluated when the metrics are read.
+    """
+
+    def __init__(self, prefix = "canalbot"):
+        self.prefix = prefix
+        # name -> (type, help, {labels: metric or function})
+        self.metrics = dict()
+
+
+    def __add(self, kind, name, help, labels, metric):
+        name = f"{self.prefix}_{name}"
+        entry = self.metrics.get(name)
+        if entry is None:
+            entry = self.metrics[name] = (kind, help, dict())
+        elif entry[0] != kind:
+            raise ValueError(f"Metric {name} already registered as {entry[0]}")
+        entry[2][tuple(sorted(labels.items())) if labels else ()] = metric
+        return metric
+
+
+    def counter(self, name, help, labels = None):
+        return self.__add(COUNTER, name, help, labels, counter())
+
+
+    def summary(self, name, help, labels = None):
+        return self.__add(SUMMARY, name, help, labels, summary())
+
+
+    def gauge(self, name, help, function, labels = None):
+        """Register a gauge read from function() at scrape time"""
+
+        self.__add(GAUGE, name, help, labels, function)
+
+
+    def counter_function(self, name, help, function, labels = None):
+        """Register a counter whose value is kept elsewhere and read from function()"""
+
+        self.__add(COUNTER, name, help, labels, function)
+
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format"""
+
+        lines = []
+        for name, (kind, help, series) in self.metrics.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in series.items():
+                if kind == SUMMARY:
+                    lines.append(f"{name}_count{format_labels(labels)} {metric.count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {metric.sum}")
+                    lines.append(f"{name}_max{format_labels(labels)} {metric.max}")
+                else:
+                    value = metric.value if isinstance(metric, counter) else metric()
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+    def serve(self, port, host = "127.0.0.1"):
+        """Serve the metrics over HTTP from a daemon thread"""
+
+        registry = self
+
+        class handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+
+    def write_periodically(self, filename, interval, loop = None):
+        """Write the metrics to filename every interval seconds.
+        Runs on the given asyncio loop or, without one, on a daemon thread.
+        """
+
+        tempname = filename + ".tmp"
+        if loop is not None:
+            def write():
+                publish(tempname, filename, self.render())
+                loop.call_later(interval, write)
+            loop.call_later(interval, write)
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                publish(tempname, filename, self.render())
+        threading.Thread(target=run, daemon=True).start()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
@@ -0,0 +1,137 @@
+import asyncio
+import functools
+import json
+
+from aiohttp import web
+
+# Compares unequal to any state value
+MISSING = object()
+
+# Minimal browser source page, renders the state like the overlay text files
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><style>
+body { color: white; font: 24px sans-serif; text-shadow: 1px 1px 2px black; white-space: pre; }
+</style></head><body><div id="info"></div><div id="vote"></div><script>
+const state = {};
+function render() {
+  const v = state.voters || {};
+  document.getElementById("info").textContent =
+    `Mode: ${state.mode}.\\nDemocrats : ${v.democracy} -  Anarchists : ${v.anarchy}` +
+    ` - Communists : ${v.communism} - Live democrats : ${v.live}\\n` +
+    (state.mode_change ? `Moving to ${state.mode_change.toLowerCase()}!` : "");
+  let vote = "";
+  if (state.leader) vote += `Leading: ${state.leader}\\n`;
+  if (state.winner) vote += `Winner: ${state.winner}\\n`;
+  if (state.plan) vote += `Plan: ${state.plan.join("")}` +
+    (state.plan_step != null ? `  Step ${state.plan_step + 1}/${state.plan.length}` : "") + "\\n";
+  document.getElementById("vote").textContent = vote;
+}
+function connect() {
+  const ws = new WebSocket(`ws://${location.host}/feed`);
+  ws.onmessage = e => { Object.assign(state, JSON.parse(e.data)); render(); };
+  ws.onclose = () => setTimeout(connect, 1000);
+}
+connect();
+</script></body></html>
+"""
+
+
+class overlayfeed:
+    """Overlay state pushed to WebSocket clients, served on the bot's loop.
+
+    publish() merges the given keys into the state and sends only the
+    changed ones, as a JSON object, to every client. A new client first
+    gets the whole state. Each client has its own sender task, and keys not
+    yet sent to a slow client are superseded by newer values instead of
+    queueing up. GET / serves a minimal page usable as an OBS browser source.
+    """
+
+    def __init__(self, loop, port, host = "127.0.0.1"):
+        self.loop = loop
+        self.port = port
+        self.host = host
+        self.state = {}
+        # websocket -> (unsent changes, wakeup event)
+        self.clients = {}
+        self.runner = None
+
+        # Statistics
+        self.published = 0
+        self.sent = 0
+
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/", self.__page)
+        app.router.add_get("/feed", self.__feed)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+
+    async def __page(self, request):
+        return web.Response(text = PAGE, content_type = "text/html")
+
+
+    async def __feed(self, request):
+        ws = web.WebSocketResponse(heartbeat = 30)
+        await ws.prepare(request)
+        pending = dict(self.state)
+        wakeup = asyncio.Event()
+        wakeup.set()
+        self.clients[ws] = (pending, wakeup)
+        sender = self.loop.create_task(self.__send(ws, pending, wakeup))
+        try:
+            # Clients have nothing to say, reading only handles pings and close
+            async for _ in ws:
+                pass
+        finally:
+            del self.clients[ws]
+            sender.cancel()
+        return ws
+
+
+    async def __send(self, ws, pending, wakeup):
+        while not ws.closed:
+            await wakeup.wait()
+            wakeup.clear()
+            if not pending:
+                continue
+            delta = dict(pending)
+            pending.clear()
+            try:
+                await ws.send_str(json.dumps(delta))
+            except ConnectionError:
+                return
+            self.sent += 1
+
+
+    def publish(self, **state):
+        """Update the state and push the changed keys. Must be called from the loop"""
+
+        delta = {key: value for key, value in state.items() if self.state.get(key, MISSING) != value}
+        if not delta:
+            return
+        self.state.update(delta)
+        self.published += 1
+        for pending, wakeup in self.clients.values():
+            pending.update(delta)
+            wakeup.set()
+
+
+    def publish_threadsafe(self, **state):
+        """publish() from any thread"""
+
+        self.loop.call_soon_threadsafe(functools.partial(self.publish, **state))
+
+
+    def close(self):
+        """Disconnect the clients and stop the server"""
+
+        if self.runner is not None and self.loop.is_running():
+            self.loop.create_task(self.runner.cleanup())
+        self.runner = None
+
+
+    def __len__(self):
+        return len(self.clients)
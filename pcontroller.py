@@ -0,0 +1,385 @@
+import multiprocessing
+import struct
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+
+from backends import create_backend
+from cmdparser import commandtable
+from fairqueue import PRIORITY_CHAT, PRIORITY_BURST
+from tcontroller import tController, FRAME_TIME, QUEUE_SIZE, DROP_OLDEST, MAX_PROGRAMS
+
+# Ring buffer records: op, last record of a message, command id, user key,
+# button mask, seconds. Padded to 32 bytes.
+RECORD = struct.Struct("<BBHIqd8x")
+RING_SIZE = 4096
+
+# Ring header. Head is written only by the producer, tail only by the
+# consumer, each on its own cache line
+HEAD = 0
+TAIL = 64
+WAITING = 128
+HEADER = 192
+INDEX = struct.Struct("<Q")
+
+# Bot -> controller operations
+OP_COMMAND = 1      # command id, user key, priority in the mask field
+OP_SEQUENCE = 2     # one command id per record, last flag ends the sequence
+OP_PROGRAM = 3      # one (mask, seconds) step per record, last flag ends the program
+OP_MODE = 4         # command id 1 for sequential mode, 0 for normal
+OP_RESET = 5
+OP_TABLE = 6        # new command table follows on the control pipe
+OP_STOP = 7
+
+# Controller -> bot events
+EV_STARTED = 1      # oldest queued sequence started
+EV_PROGRESS = 2     # command id field holds the step index
+
+# Controller statistics shared with the bot
+STAT_DEPTH = 0
+STAT_DROPPED = 1
+STAT_COALESCED = 2
+STAT_UPDATES = 3
+STAT_ABSORBED = 4
+STAT_RELEASES = 5
+STAT_ERROR_MEAN = 6
+STAT_ERROR_MAX = 7
+STAT_FIELDS = 8
+STATS_INTERVAL = 0.1
+
+# Bot side event polling interval
+EVENT_INTERVAL = 0.02
+
+# Poll interval while waiting for room for a control operation
+CONTROL_WAIT = 0.001
+
+
+class ringbuffer:
+    """Single producer, single consumer ring of fixed-size records in shared memory.
+
+    The producer only writes the head index and the consumer only the tail,
+    so no lock is needed. Records of a put() become visible to the consumer
+    at once, when the head is advanced after all of them are written.
+    """
+
+    def __init__(self, capacity = RING_SIZE, name = None):
+        self.capacity = capacity
+        create = name is None
+        self.shm = shared_memory.SharedMemory(name = name, create = create,
+                                              size = HEADER + capacity * RECORD.size)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        if create:
+            self.buf[:HEADER] = bytes(HEADER)
+        self.full = 0
+
+
+    def put(self, records):
+        """Write a list of record tuples. Returns False if they do not fit"""
+
+        buf = self.buf
+        head = INDEX.unpack_from(buf, HEAD)[0]
+        tail = INDEX.unpack_from(buf, TAIL)[0]
+        if head - tail + len(records) > self.capacity:
+            self.full += 1
+            return False
+        for record in records:
+            RECORD.pack_into(buf, HEADER + (head % self.capacity) * RECORD.size, *record)
+            head += 1
+        INDEX.pack_into(buf, HEAD, head)
+        return True
+
+
+    def get(self):
+        """Return the next record tuple, None if the ring is empty"""
+
+        buf = self.buf
+        tail = INDEX.unpack_from(buf, TAIL)[0]
+        if tail == INDEX.unpack_from(buf, HEAD)[0]:
+            return None
+        record = RECORD.unpack_from(buf, HEADER + (tail % self.capacity) * RECORD.size)
+        INDEX.pack_into(buf, TAIL, tail + 1)
+        return record
+
+
+    def empty(self):
+        return INDEX.unpack_from(self.buf, TAIL)[0] == INDEX.unpack_from(self.buf, HEAD)[0]
+
+
+    def wait(self, wakeup, timeout):
+        """Consumer side: sleep on the wakeup event until records arrive or timeout"""
+
+        INDEX.pack_into(self.buf, WAITING, 1)
+        if self.empty():
+            wakeup.wait(timeout)
+        INDEX.pack_into(self.buf, WAITING, 0)
+        wakeup.clear()
+
+
+    def waiting(self):
+        """Producer side: True if the consumer is asleep and needs the wakeup event set"""
+
+        return INDEX.unpack_from(self.buf, WAITING)[0] != 0
+
+
+    def __len__(self):
+        return INDEX.unpack_from(self.buf, HEAD)[0] - INDEX.unpack_from(self.buf, TAIL)[0]
+
+
+    def close(self, unlink = False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def run_controller(command_ring, event_ring, capacity, wakeup, stats, control,
+                   buttons, cmds, frame_time, backend, device, queue_size, queue_policy, max_programs,
+                   priority_burst):
+    """Controller process main loop. Executes records from the command ring
+    on a tController and reports sequence progress on the event ring.
+    """
+
+    commands = ringbuffer(capacity, command_ring)
+    events = ringbuffer(capacity, event_ring)
+    joy = tController(buttons, cmds, frame_time, create_backend(backend, device),
+                      queue_size, queue_policy, max_programs, priority_burst)
+    joy.daemon = True
+
+    # Events come from this thread and the scheduler thread
+    events_lock = threading.Lock()
+    def started():
+        with events_lock:
+            events.put([(EV_STARTED, 1, 0, 0, 0, 0.0)])
+    def progress(seq, step):
+        with events_lock:
+            events.put([(EV_PROGRESS, 1, step, 0, 0, 0.0)])
+    joy.sequence_started = started
+    joy.sequence_progress = progress
+    joy.start()
+
+    seq = []
+    program = []
+    last_stats = 0.0
+    while True:
+        now = time.monotonic()
+        if now - last_stats >= STATS_INTERVAL:
+            last_stats = now
+            depth, stats[STAT_DROPPED], stats[STAT_COALESCED] = joy.queue_stats()
+            stats[STAT_DEPTH] = depth
+            stats[STAT_UPDATES], stats[STAT_ABSORBED] = joy.update_stats()
+            stats[STAT_RELEASES], stats[STAT_ERROR_MEAN], stats[STAT_ERROR_MAX] = joy.hold_stats()
+
+        record = commands.get()
+        if record is None:
+            commands.wait(wakeup, STATS_INTERVAL)
+            continue
+        op, last, cmd, user, mask, seconds = record
+        if op == OP_COMMAND:
+            joy.queue_command(cmd, user or None, mask)
+        elif op == OP_SEQUENCE:
+            seq.append(cmd)
+            if last:
+                joy.queue_sequence(seq)
+                seq = []
+        elif op == OP_PROGRAM:
+            program.append((mask, seconds))
+            if last:
+                joy.queue_program(tuple(program))
+                program = []
+        elif op == OP_MODE:
+            if cmd:
+                joy.set_sequential_mode()
+            else:
+                joy.set_normal_mode()
+        elif op == OP_RESET:
+            joy.reset()
+        elif op == OP_TABLE:
+            joy.set_table(control.recv())
+        elif op == OP_STOP:
+            joy.set_normal_mode()
+            joy.reset()
+            break
+    commands.close()
+    events.close()
+
+
+class pController:
+    """Controller running in its own process, with the tController interface.
+
+    Commands, sequences and programs are sent as fixed-size records over a
+    shared memory ring buffer, so button timing does not depend on chat
+    load or the bot's GIL. Sequence progress comes back over a second ring,
+    polled on the bot's loop, and statistics through a shared array.
+    """
+
+    def __init__(self, loop, buttons : int, cmds: commandtable, frame_time = FRAME_TIME,
+                 backend = "vjoy", queue_size = QUEUE_SIZE, queue_policy = DROP_OLDEST,
+                 max_programs = MAX_PROGRAMS, priority_burst = PRIORITY_BURST, device = 1,
+                 ring_size = RING_SIZE):
+        self.loop = loop
+        self.cmds = cmds
+        self.commands = ringbuffer(ring_size)
+        self.events = ringbuffer(ring_size)
+        self.wakeup = multiprocessing.Event()
+        self.stats = multiprocessing.RawArray("d", STAT_FIELDS)
+        self.control, child_control = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target = run_controller, name = "controller", daemon = True,
+            args = (self.commands.name, self.events.name, ring_size, self.wakeup, self.stats,
+                    child_control, buttons, cmds, frame_time, backend, device,
+                    queue_size, queue_policy, max_programs, priority_burst))
+        self.poll_handle = None
+
+        # Sent sequences, to match the progress events with
+        self.sequences = deque()
+        self.sequence = None
+        self.sequence_step = 0
+        self.sequence_started = None
+        self.sequence_progress = None
+
+
+    def start(self):
+        self.process.start()
+        self.poll_handle = self.loop.call_later(EVENT_INTERVAL, self.__poll)
+
+
+    def __send(self, records):
+        if not self.commands.put(records):
+            return False
+        if self.commands.waiting():
+            self.wakeup.set()
+        return True
+
+
+    def __send_control(self, records):
+        """Send records that must not be dropped, waiting until the controller
+        makes room for them. Returns False only if the controller process is gone.
+        """
+
+        commands = self.commands
+        while commands.capacity - len(commands) < len(records):
+            if not self.process.is_alive():
+                return False
+            self.wakeup.set()
+            time.sleep(CONTROL_WAIT)
+        return self.__send(records)
+
+
+    def __poll(self):
+        """Dispatch sequence events from the controller process"""
+
+        while True:
+            record = self.events.get()
+            if record is None:
+                break
+            if record[0] == EV_STARTED:
+                self.sequence = self.sequences.popleft() if self.sequences else None
+                self.sequence_step = 0
+                if self.sequence_started is not None:
+                    self.sequence_started()
+            elif record[0] == EV_PROGRESS and self.sequence is not None:
+                self.sequence_step = record[2]
+                if self.sequence_progress is not None:
+                    self.sequence_progress(self.sequence, self.sequence_step)
+        self.poll_handle = self.loop.call_later(EVENT_INTERVAL, self.__poll)
+
+
+    def queue_command(self, cmd, user = None, priority = PRIORITY_CHAT):
+        """Send the command to the controller process. The user is sent as a hash key"""
+
+        key = (hash(user) & 0x7fffffff) | 1 if user is not None else 0
+        self.__send([(OP_COMMAND, 1, cmd, key, priority, 0.0)])
+
+
+    def queue_sequence(self, seq):
+        last = len(seq) - 1
+        if self.__send([(OP_SEQUENCE, i == last, cmd, 0, 0, 0.0) for i, cmd in enumerate(seq)]):
+            self.sequences.append(seq)
+
+
+    def queue_program(self, program):
+        last = len(program) - 1
+        self.__send([(OP_PROGRAM, i == last, 0, 0, mask, seconds)
+                     for i, (mask, seconds) in enumerate(program)])
+
+
+    def set_sequential_mode(self):
+        self.__send_control([(OP_MODE, 1, 1, 0, 0, 0.0)])
+
+
+    def set_normal_mode(self):
+        self.sequences.clear()
+        self.sequence = None
+        self.__send_control([(OP_MODE, 1, 0, 0, 0, 0.0)])
+
+
+    def reset(self):
+        self.__send_control([(OP_RESET, 1, 0, 0, 0, 0.0)])
+
+
+    def set_table(self, cmds: commandtable):
+        """Swap in a reloaded command table. Ids of the current table must stay valid"""
+
+        self.cmds = cmds
+        # The record tells the controller to read the table, so it must not be dropped
+        self.control.send(cmds)
+        self.__send_control([(OP_TABLE, 1, 0, 0, 0, 0.0)])
+
+
+    def sequence_status(self):
+        if self.sequence is None:
+            return None
+        return self.sequence, self.sequence_step
+
+
+    def queue_stats(self):
+        """Return queue depth and dropped/coalesced command counts.
+        Commands not fitting the ring buffer are counted as dropped.
+        """
+
+        return (int(self.stats[STAT_DEPTH]), int(self.stats[STAT_DROPPED]) + self.commands.full,
+                int(self.stats[STAT_COALESCED]))
+
+
+    def update_stats(self):
+        return int(self.stats[STAT_UPDATES]), self.stats[STAT_ABSORBED]
+
+
+    def hold_stats(self):
+        return int(self.stats[STAT_RELEASES]), self.stats[STAT_ERROR_MEAN], self.stats[STAT_ERROR_MAX]
+
+
+    @property
+    def dropped(self):
+        return self.queue_stats()[1]
+
+
+    @property
+    def coalesced(self):
+        return int(self.stats[STAT_COALESCED])
+
+
+    @property
+    def update_count(self):
+        return int(self.stats[STAT_UPDATES])
+
+
+    @property
+    def hold_count(self):
+        return int(self.stats[STAT_RELEASES])
+
+
+    def close(self):
+        """Stop the controller process, releasing all buttons, and free the rings"""
+
+        if self.poll_handle is not None:
+            self.poll_handle.cancel()
+            self.poll_handle = None
+        if self.process.is_alive():
+            self.__send_control([(OP_STOP, 1, 0, 0, 0, 0.0)])
+            self.wakeup.set()
+            self.process.join(2)
+        self.commands.close(unlink = True)
+        self.events.close(unlink = True)
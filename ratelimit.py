@@ -0,0 +1,62 @@
+import sys
+import time
+
+# Default per-user command rate (commands/s) and burst size
+USER_RATE = 2.0
+USER_BURST = 5
+
+
+class tokenbuckets:
+    """Per-user token buckets.
+
+    Each bucket is stored as a single float, the time at which it will be
+    full again (GCRA form of a token bucket). A bucket whose full time has
+    passed carries no information, so idle users are dropped from the dict
+    and memory stays flat regardless of how many people have chatted.
+    """
+
+    def __init__(self, rate = USER_RATE, burst = USER_BURST):
+        self.interval = 1 / rate
+        self.burst = burst
+        self.window = self.interval * burst
+        # user -> full time. Insertion order is kept as least recently used first
+        self.buckets = dict()
+        self.limited = 0
+
+
+    def allow(self, user, cost = 1, now = None):
+        """Take cost tokens from user's bucket. Returns False if there are not enough tokens.
+        A cost above burst needs a full bucket and leaves it in debt, so long
+        messages pass but the user still waits for every token they took.
+        """
+
+        if now is None:
+            now = time.monotonic()
+        self.expire(now)
+
+        full = self.buckets.pop(user, now)
+        if full < now:
+            full = now
+        if full + self.interval * min(cost, self.burst) - now > self.window:
+            self.buckets[user] = full
+            self.limited += 1
+            return False
+        self.buckets[sys.intern(user)] = full + self.interval * cost
+        return True
+
+
+    def expire(self, now, limit = 2):
+        """Drop up to limit idle buckets from the least recently used end"""
+
+        buckets = self.buckets
+        for i in range(limit):
+            if not buckets:
+                return
+            user = next(iter(buckets))
+            if buckets[user] > now:
+                return
+            del buckets[user]
+
+
+    def __len__(self):
+        return len(self.buckets)
@@ -0,0 +1,150 @@
+import heapq
+import threading
+import time
+
+# Wake up this much before a deadline and spin the rest of the way.
+# Condition.wait is too coarse on Windows for millisecond hold times.
+SPIN_MARGIN = 0.002
+
+
+class timerhandle:
+    """Handle for a scheduled callback. Cancelling is O(1), cancelled
+    entries are discarded lazily when they reach the top of the heap."""
+
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class releasescheduler(threading.Thread):
+    """Single thread callback scheduler using a monotonic deadline heap.
+    Replaces one threading.Timer per button press.
+    """
+
+    def __init__(self, spin_margin = SPIN_MARGIN):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.spin_margin = spin_margin
+        self.condition = threading.Condition()
+        self.heap = []
+        self.counter = 0
+
+        # Lateness of executed callbacks, seconds
+        self.late_count = 0
+        self.late_total = 0.0
+        self.late_max = 0.0
+
+
+    def call_at(self, deadline, callback, *args):
+        """Schedule callback at the given time.monotonic() deadline"""
+
+        handle = timerhandle(deadline, callback, args)
+        with self.condition:
+            self.counter += 1
+            heapq.heappush(self.heap, (deadline, self.counter, handle))
+            # Only wake the thread if the new entry is the earliest one
+            if self.heap[0][2] is handle:
+                self.condition.notify()
+        return handle
+
+
+    def call_later(self, delay, callback, *args):
+        """Schedule callback after delay seconds"""
+
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+
+    def run(self):
+        """Main loop"""
+
+        while True:
+            with self.condition:
+                while True:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    deadline, _, handle = self.heap[0]
+                    remaining = deadline - time.monotonic() - self.spin_margin
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+            # Spin out the last part of the wait for accuracy
+            while time.monotonic() < deadline:
+                time.sleep(0)
+
+            with self.condition:
+                if not self.heap or self.heap[0][2] is not handle:
+                    continue
+                heapq.heappop(self.heap)
+                if handle.cancelled:
+                    continue
+
+            late = time.monotonic() - deadline
+            self.late_count += 1
+            self.late_total += late
+            if late > self.late_max:
+                self.late_max = late
+            handle.callback(*handle.args)
+
+
+    def timing_error(self):
+        """Return callback count, mean and max lateness in milliseconds"""
+
+        if not self.late_count:
+            return 0, 0.0, 0.0
+        return self.late_count, self.late_total / self.late_count * 1000, self.late_max * 1000
+
+
+class loopscheduler:
+    """Scheduler running callbacks on an asyncio event loop with loop.call_at.
+    Same interface as releasescheduler, the returned asyncio.TimerHandle cancels in O(1).
+    Deadlines are time.monotonic() based, as is loop.time().
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+        # Lateness of executed callbacks, seconds
+        self.late_count = 0
+        self.late_total = 0.0
+        self.late_max = 0.0
+
+
+    def call_at(self, deadline, callback, *args):
+        """Schedule callback at the given time.monotonic() deadline"""
+
+        return self.loop.call_at(deadline, self.__run, deadline, callback, args)
+
+
+    def call_later(self, delay, callback, *args):
+        """Schedule callback after delay seconds"""
+
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+
+    def __run(self, deadline, callback, args):
+        late = time.monotonic() - deadline
+        self.late_count += 1
+        self.late_total += late
+        if late > self.late_max:
+            self.late_max = late
+        callback(*args)
+
+
+    def timing_error(self):
+        """Return callback count, mean and max lateness in milliseconds"""
+
+        if not self.late_count:
+            return 0, 0.0, 0.0
+        return self.late_count, self.late_total / self.late_count * 1000, self.late_max * 1000
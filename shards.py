@@ -0,0 +1,123 @@
+"""Run several channel -> controller device shards from one config.
+
+Each entry of "shards" in config.json overrides keys of the base config,
+at least "channel" and "device". Every shard is a separate CanalBot with
+its own controller, votes and files. Output files not given in the shard
+entry get the channel name appended, eg. log.txt -> log-canalchan.txt.
+
+With "shard_processes" each shard runs in its own worker process, so a
+busy channel cannot slow down the others. Otherwise all shards share one
+process and event loop.
+
+Usage:
+    python shards.py [config.json]
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+
+import canalbot
+
+# Per shard output files, derived from the base names when not given
+FILE_KEYS = ("info_file", "vote_info_file", "log_file", "stats_file", "journal_file", "snapshot_file",
+             "event_log_file")
+
+
+def shard_filename(filename, channel):
+    """Return filename with the channel name appended"""
+
+    base, ext = os.path.splitext(filename)
+    return f"{base}-{channel.lstrip('#')}{ext}"
+
+
+def shard_configs(config):
+    """Return the full bot config of each shard.
+    A config without "shards" is a single shard.
+    """
+
+    shards = config.get("shards")
+    if not shards:
+        return [config]
+
+    configs = []
+    channels = set()
+    devices = set()
+    for i, shard in enumerate(shards):
+        if "channel" not in shard or "device" not in shard:
+            raise ValueError(f"Shard {i} needs a channel and a device")
+        shard_config = {k: v for k, v in config.items() if k != "shards"}
+        shard_config.update(shard)
+        channel = shard_config["channel"]
+        for key in FILE_KEYS:
+            if key not in shard and shard_config.get(key):
+                shard_config[key] = shard_filename(shard_config[key], channel)
+        for key in ("metrics_port", "overlay_port"):
+            if key not in shard and shard_config.get(key):
+                shard_config[key] += i
+
+        device = (shard_config.get("backend", "vjoy"), shard_config["device"])
+        if channel in channels:
+            raise ValueError(f"Channel {channel} is in more than one shard")
+        if device in devices:
+            raise ValueError(f"Device {device[1]} is in more than one shard")
+        channels.add(channel)
+        devices.add(device)
+        configs.append(shard_config)
+    return configs
+
+
+def run_shard(config):
+    """Run a single shard until it stops. Target of the worker processes"""
+
+    bot = canalbot.CanalBot(config)
+    try:
+        bot.run()
+    finally:
+        bot.shutdown()
+
+
+def run_shards(configs):
+    """Run all shards on one event loop in this process"""
+
+    bots = [canalbot.CanalBot(config) for config in configs]
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(asyncio.gather(*(bot.start() for bot in bots)))
+    finally:
+        for bot in bots:
+            bot.shutdown()
+
+
+def run_processes(configs):
+    """Run each shard in its own worker process and wait for them"""
+
+    workers = [multiprocessing.Process(target = run_shard, args = (config,),
+                                       name = f"shard {config['channel']}")
+               for config in configs]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+
+def main():
+    cfgfile = sys.argv[1] if len(sys.argv) > 1 else "config.json"
+    with open(cfgfile, "r") as cfg:
+        config = json.load(cfg)
+    configs = shard_configs(config)
+    if config.get("shard_processes", False) and len(configs) > 1:
+        run_processes(configs)
+    else:
+        run_shards(configs)
+
+
+if __name__ == "__main__":
+    main()
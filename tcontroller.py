@@ -1,132 +1,325 @@
-import pyvjoy
+import contextlib
 import threading
 import time
+from collections import Counter
+from scheduler import releasescheduler, loopscheduler
+from fairqueue import priorityqueue, PRIORITY_CHAT, PRIORITY_BURST
+from cmdparser import commandtable, STEP_GAP
+from backends import vjoybackend
 
 READY = 1
 EXEC_UNTIL_EMPTY = 2
 
-class tController(threading.Thread):
+# Default device update tick, one 60 Hz game frame
+FRAME_TIME = 1 / 60
 
-    
-    def __init__(self, buttons : int, cmds: dict, holdtime, holdtime_long):
+# Command queue overload policies
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+COALESCE = "coalesce"
+QUEUE_SIZE = 64
+
+# Default limit for programs running at the same time
+MAX_PROGRAMS = 4
+
+class controllercore:
+    """Button state, press timing and command queue shared by the controller engines.
+    The engine provides the scheduler for releases/frame flushes and the lock.
+    """
+
+
+    def __init__(self, buttons : int, cmds: commandtable, frame_time,
+                 backend, queue_size, queue_policy, scheduler, lock, max_programs,
+                 priority_burst):
         if isinstance(buttons, int):
-            self.buttons = ["0" for i in range(buttons)]
+            self.buttons = buttons
         else:
-            raise typeError("buttons argument must be a number")
-        if isinstance(cmds, dict):
+            raise TypeError("buttons argument must be a number")
+        if isinstance(cmds, commandtable):
             self.cmds = cmds
         else:
-            raise typeError("cmdlist argument needs to be a list")
-        
-        threading.Thread.__init__(self)
-        self.timers = list(range(buttons))
-        self.joy1 = pyvjoy.VJoyDevice(1)
-        self.holdtime = holdtime
-        self.holdtime_long = holdtime_long
-        
-        self.lock = threading.Lock()
-        self.condition = threading.Condition()
-        
-        self.status = EXEC_UNTIL_EMPTY
+            raise TypeError("cmds argument needs to be a commandtable")
+
+        # Release timer, press time and press count per button. The count
+        # tells a release callback whether its press is still the latest one
+        self.timers = [None] * buttons
+        self.pressed_at = [0.0] * buttons
+        self.presses = [0] * buttons
+        if queue_policy not in (DROP_OLDEST, DROP_NEWEST, COALESCE):
+            raise ValueError(f"Unknown queue policy: {queue_policy}")
+        if backend is None:
+            backend = vjoybackend(1)
+        self.backend = backend
+
+        self.lock = lock
+        self.scheduler = scheduler
+
+        # Button state as bitmask. Changes are collected and written to the
+        # device once per frame.
+        self.frame_time = frame_time
+        self.state = 0
+        self.written_state = 0
+        self.pending_changes = 0
+        self.flush_scheduled = False
+        self.flush_at = 0.0
+
+        # Update statistics. batch_sizes maps absorbed changes -> number of updates
+        self.update_count = 0
+        self.batch_sizes = Counter()
+
+        # Hold time accuracy, device write time of a release minus intended release time
+        self.hold_count = 0
+        self.hold_error_total = 0.0
+        self.hold_error_max = 0.0
+
+        # Sequences run one at a time from scheduler deadlines. Cancelling bumps
+        # the generation, which invalidates the already scheduled step.
         self.sequence_exec = False
         self.sequences = []
-        self.queue = []
+        self.sequence = None
+        self.sequence_step = 0
+        self.sequence_generation = 0
+        # Optional callbacks, called when a queued sequence is started and
+        # with (sequence, step index) when a step is pressed
+        self.sequence_started = None
+        self.sequence_progress = None
 
+        # Bounded command queue, served by priority and round-robin across users
+        # within a priority. Overflow is handled by queue_policy
+        self.queue = priorityqueue(burst = priority_burst)
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.dropped = 0
+        self.coalesced = 0
 
+        # Programs run from scheduler deadlines, at most max_programs at once
+        self.max_programs = max_programs
+        self.running_programs = 0
+        self.step_gap = max(STEP_GAP, frame_time)
 
-    def __update_joystick(self, idx, value):
-        self.lock.acquire()
-        
-        self.buttons[idx] = str(value)
-        # Copy buttons, reverse order and concatenate
-        newstate = self.buttons.copy()
-        newstate.reverse()
-        newstate = "".join(newstate)
 
-        # Convert the string binary representation into numeric value, set as new state
-        self.joy1.data.lButtons = int(newstate, 2)
-        self.joy1.update()
-        
-        self.lock.release()
-                
+    def _update_joystick(self, idx, value):
+        """Set or clear the button bit. The device write happens on the next frame."""
 
-    def run(self):
-        """Main loop"""
-        
-        execute = 0
-        while(True):
-            # Check status and if necessary wait for commands from queue/sequence
-            with self.condition:
-                if self.status == READY:
-                    self.status = EXEC_UNTIL_EMPTY
-                    execute = 1
-                else:
-                    self.condition.wait()
-            
-            # If execute is set, there should be data. Check and execute
-            if execute:
-                execute = 0
-                # Always ensure that queued commands are executed first.
-                while self.queue:
-                    cmd = self.queue.pop(0)
-                    self.__button_press(cmd)
-            
-                # Check if we need to execute sequences.
-                if self.sequence_exec:
-                    while self.sequences:
-                        seq = self.sequences.pop(0)
-                        for cmd in seq:
-                            self.__ordered_button_press(cmd)
-            
-                
-    def __button_press(self, cmd):
+        self._update_buttons(1 << idx, value)
+
+
+    def _update_buttons(self, mask, value):
+        """Set or clear all bits of the button mask as one change"""
+
+        with self.lock:
+            flush_now = self._change_buttons(mask, value)
+        if flush_now:
+            self._flush()
+
+
+    def _change_buttons(self, mask, value):
+        """Set or clear the bits and schedule the frame flush.
+        Returns True if the caller has to flush at once.
+        Ensure that you have acquired the lock as this is not done here!
+        """
+
+        if value:
+            self.state |= mask
+        else:
+            self.state &= ~mask
+        self.pending_changes += 1
+        if self.frame_time <= 0:
+            return True
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            now = time.monotonic()
+            next_frame = (now // self.frame_time + 1) * self.frame_time
+            self.flush_at = next_frame
+            self.scheduler.call_at(next_frame, self._flush)
+        return False
+
+
+    def _write_time(self):
+        """Return when the pending changes reach the device.
+        Ensure that you have acquired the lock as this is not done here!
+        """
+
+        return self.flush_at if self.flush_scheduled else time.monotonic()
+
+
+    def _flush(self):
+        """Write the current button state to the device if there are pending changes"""
+
+        with self.lock:
+            self.flush_scheduled = False
+            self._write()
+
+
+    def _write(self):
+        """Write the pending changes to the device now.
+        Ensure that you have acquired the lock as this is not done here!
+        """
+
+        if not self.pending_changes:
+            return
+        changes = self.pending_changes
+        self.pending_changes = 0
+        if self.state != self.written_state:
+            self.backend.write(self.state)
+            self.written_state = self.state
+        self.update_count += 1
+        self.batch_sizes[changes] += 1
+
+
+    def update_stats(self):
+        """Return device update count and average number of changes absorbed per update"""
+
+        with self.lock:
+            changes = sum(size * count for size, count in self.batch_sizes.items())
+            average = changes / self.update_count if self.update_count else 0
+            return self.update_count, average
+
+
+    def hold_stats(self):
+        """Return measured release count, mean and max absolute release time error in ms"""
+
+        if not self.hold_count:
+            return 0, 0.0, 0.0
+        return (self.hold_count,
+                self.hold_error_total / self.hold_count * 1000,
+                self.hold_error_max * 1000)
+
+
+    def _button_press(self, cmd):
         """Presses the button matching the given command.
-        Will launch a timer thread to automatically release the button.
+        The release is scheduled on the scheduler.
         """
-    
-        if self.__press(cmd):
-            idx = self.cmds[cmd]
-            if len(cmd) == 1:
-                holdtime = self.holdtime
-            else:
-                holdtime = self.holdtime_long
-            self.timers[idx] = threading.Timer(holdtime, self.__release, args=(cmd,))
-            self.timers[idx].start()
-
-
-    def __ordered_button_press(self, cmd):
-        """Executes one complete buttonpress. 
-        This blocks until the press/release action is completed.
-        Intended for ensuring the order of execution"""
-        
-        if self.__press(cmd):
-            if len(cmd) == 1:
-                holdtime = self.holdtime
-            else:
-                holdtime = self.holdtime_long
-            time.sleep(holdtime)
-            self.__release(cmd)
-        
-        
-    def __press(self, cmd):
+
+        cmds = self.cmds
+        if self._press(cmd):
+            idx = cmds.buttons[cmd]
+            with self.lock:
+                # A newer press schedules its own release
+                if self.timers[idx] is None:
+                    deadline = self.pressed_at[idx] + cmds.holds[cmd]
+                    self.timers[idx] = self.scheduler.call_at(deadline, self._timed_release, idx,
+                                                              deadline, self.presses[idx])
+
+
+    def _timed_release(self, idx, deadline, press):
+        """Scheduler callback releasing the button, records the release time error.
+        The release is written at once instead of on the next frame, so hold
+        times are not quantized to frames, and the error is measured after the write.
+        Does nothing if the button was pressed again after this release was scheduled,
+        the cancel may come too late for a callback that is already running.
+        """
+
+        with self.lock:
+            if self.presses[idx] != press:
+                return
+            self.timers[idx] = None
+            self.state &= ~(1 << idx)
+            self.pending_changes += 1
+            self._write()
+            error = abs(time.monotonic() - deadline)
+            self.hold_count += 1
+            self.hold_error_total += error
+            if error > self.hold_error_max:
+                self.hold_error_max = error
+
+
+    def _cancel_release(self, idx):
+        """Cancel the pending release of the button and invalidate a running one.
+        Ensure that you have acquired the lock as this is not done here!
+        """
+
+        if self.timers[idx] is not None:
+            self.timers[idx].cancel()
+            self.timers[idx] = None
+        self.presses[idx] += 1
+
+
+    def _press(self, cmd):
         try:
-            idx = self.cmds[cmd]
-        except KeyError:
+            idx = self.cmds.buttons[cmd]
+        except IndexError:
             raise KeyError("Given command not listed.")
-        else: 
-            if self.timers[idx] != idx:
-                self.timers[idx].cancel()
-            self.__update_joystick(idx, 1)
+        else:
+            with self.lock:
+                self._cancel_release(idx)
+                # A release still waiting for the frame flush would merge with
+                # this press, write it first so the device sees the button go up
+                if self.written_state & ~self.state & (1 << idx):
+                    self._write()
+                flush_now = self._change_buttons(1 << idx, 1)
+                # Holds are timed from the device write of the press
+                self.pressed_at[idx] = self._write_time()
+            if flush_now:
+                self._flush()
             return True
 
 
-    def __release(self, cmd):
+    def _press_chord(self, mask, deadline):
+        """Press all buttons of the mask in one update, each released at deadline.
+        The deadline moves with the device write of the press, keeping the hold time.
+        """
+
+        now = time.monotonic()
+        bits = mask
+        with self.lock:
+            # A release of these buttons still waiting for the frame flush would be
+            # merged with this press, write it first so repeated taps stay separate
+            if self.written_state & mask & ~self.state:
+                self._write()
+            flush_now = self._change_buttons(mask, 1)
+            written = self._write_time()
+            deadline += written - now
+            while bits:
+                low = bits & -bits
+                idx = low.bit_length() - 1
+                bits ^= low
+                self._cancel_release(idx)
+                self.pressed_at[idx] = written
+                self.timers[idx] = self.scheduler.call_at(deadline, self._timed_release, idx,
+                                                          deadline, self.presses[idx])
+        if flush_now:
+            self._flush()
+
+
+    def queue_program(self, program):
+        """Start a compiled program, a tuple of (button mask, seconds) steps.
+        Steps run from scheduler deadlines, so programs interleave with other commands.
+        The program is dropped if max_programs are already running.
+        """
+
+        with self.lock:
+            if self.running_programs >= self.max_programs:
+                self.dropped += 1
+                return
+            self.running_programs += 1
+        now = time.monotonic()
+        self.scheduler.call_at(now, self._program_step, program, 0, now)
+
+
+    def _program_step(self, program, i, at):
+        """Scheduler callback executing step i of the program, due at the given time"""
+
+        if i == len(program):
+            with self.lock:
+                self.running_programs -= 1
+            return
+        mask, seconds = program[i]
+        if mask:
+            self._press_chord(mask, at + seconds)
+            at += seconds + self.step_gap
+        else:
+            at += seconds
+        self.scheduler.call_at(at, self._program_step, program, i + 1, at)
+
+
+    def _release(self, cmd):
         try:
-            idx = self.cmds[cmd]
-        except KeyError:
+            idx = self.cmds.buttons[cmd]
+        except IndexError:
             raise KeyError("Given command not listed.")
         else:
-            self.__update_joystick(idx, 0)
+            self._update_joystick(idx, 0)
             return True
 
 
@@ -134,37 +327,243 @@ class tController(threading.Thread):
         """Resets timers and releases buttons"""
 
         print("tController:  Doing controller reset....")
-        # Cancel all timers
-        for idx, timer in enumerate(self.timers):
-            if timer != idx:
-                timer.cancel()
-        # Release all buttons
-        for command in self.cmds.keys():
-            self.__release(command)
-            
-            
-    def queue_command(self, cmd):
-        """Enter the given command to execution queue"""
-        
-        self.queue.append(cmd)
-        with self.condition:
-            self.status = READY
-            self.condition.notify()
-        
-    
+        # Cancel all timers and release all buttons with a single update
+        with self.lock:
+            for idx in range(len(self.timers)):
+                self._cancel_release(idx)
+            self.state = 0
+            self.written_state = -1
+            self.pending_changes += 1
+        self._flush()
+
+
+    def _enqueue(self, cmd, user, priority):
+        """Add command to the queue, applying the overload policy if full.
+        Returns False if the command was not queued.
+        Ensure that you have acquired the queue lock as this is not done here!
+        """
+
+        if len(self.queue) >= self.queue_size and not self.__make_room(cmd, user, priority):
+            return False
+        self.queue.append(cmd, user, priority)
+        return True
+
+
+    def __make_room(self, cmd, user, priority):
+        """Apply the overload policy to a full queue.
+        Commands are shed from the user with most queued commands at the
+        lowest queued priority, so higher priority commands always get in.
+        Returns True if the new command should still be queued.
+        """
+
+        if self.queue_policy == DROP_NEWEST and self.queue.lowest() >= priority:
+            self.dropped += 1
+            return False
+
+        if self.queue_policy == COALESCE:
+            lane = self.queue.lane(user, priority)
+            if lane and lane[-1] == cmd:
+                self.coalesced += 1
+                return False
+            # Merge consecutive identical commands into one press
+            self.coalesced += self.queue.compact(self.queue.longest())
+            if len(self.queue) < self.queue_size:
+                return True
+
+        self.queue.drop(self.queue.longest())
+        self.dropped += 1
+        return True
+
+
+    def set_table(self, cmds: commandtable):
+        """Swap in a reloaded command table. Ids of the current table must stay valid"""
+
+        self.cmds = cmds
+
+
+    def queue_stats(self):
+        """Return current queue depth and dropped/coalesced command counts"""
+
+        return len(self.queue), self.dropped, self.coalesced
+
+
     def queue_sequence(self, seq):
         """Enter the given sequence to sequence queue"""
 
-        self.sequences.append(seq)
-        with self.condition:
-            self.status = READY
-            self.condition.notify()
-            
-            
+        with self.lock:
+            self.sequences.append(seq)
+        self._next_sequence()
+
+
+    def _next_sequence(self):
+        """Start the oldest queued sequence unless one is already running"""
+
+        with self.lock:
+            if self.sequence is not None or not self.sequence_exec or not self.sequences:
+                return
+            self.sequence = self.sequences.pop(0)
+            self.sequence_step = 0
+            generation = self.sequence_generation
+        if self.sequence_started is not None:
+            self.sequence_started()
+        self._sequence_step(generation, time.monotonic())
+
+
+    def _sequence_step(self, generation, at):
+        """Press the next step of the running sequence, due at the given time.
+        The release and the following step are scheduled, nothing blocks.
+        """
+
+        with self.lock:
+            if generation != self.sequence_generation:
+                return
+            seq = self.sequence
+            step = self.sequence_step
+            if step == len(seq):
+                self.sequence = None
+            else:
+                self.sequence_step = step + 1
+        if step == len(seq):
+            self._next_sequence()
+            return
+
+        if self.sequence_progress is not None:
+            self.sequence_progress(seq, step)
+        cmds = self.cmds
+        cmd = seq[step]
+        deadline = at + cmds.holds[cmd]
+        self._press_chord(1 << cmds.buttons[cmd], deadline)
+        self.scheduler.call_at(deadline + self.step_gap, self._sequence_step,
+                               generation, deadline + self.step_gap)
+
+
+    def sequence_status(self):
+        """Return the running sequence and index of its current step, None if not running"""
+
+        with self.lock:
+            if self.sequence is None:
+                return None
+            return self.sequence, self.sequence_step - 1
+
+
     def set_sequential_mode(self):
-        self.sequence_exec = True
-        
-    
+        with self.lock:
+            self.sequence_exec = True
+        self._next_sequence()
+
+
     def set_normal_mode(self):
-        self.sequence_exec = False
-        self.sequences = []
+        """Stop sequence execution. The running sequence is cancelled
+        immediately and the button of its current step released.
+        """
+
+        with self.lock:
+            self.sequence_exec = False
+            self.sequences = []
+            seq = self.sequence
+            step = self.sequence_step - 1
+            self.sequence = None
+            self.sequence_generation += 1
+        if seq is not None and 0 <= step < len(seq):
+            idx = self.cmds.buttons[seq[step]]
+            with self.lock:
+                self._cancel_release(idx)
+                flush_now = self._change_buttons(1 << idx, 0)
+            if flush_now:
+                self._flush()
+
+
+class tController(controllercore, threading.Thread):
+    """Threaded controller engine. Commands are executed by the controller thread,
+    releases, frame flushes, programs and sequences run on a releasescheduler thread.
+    """
+
+
+    def __init__(self, buttons : int, cmds: commandtable, frame_time = FRAME_TIME,
+                 backend = None, queue_size = QUEUE_SIZE, queue_policy = DROP_OLDEST,
+                 max_programs = MAX_PROGRAMS, priority_burst = PRIORITY_BURST):
+        threading.Thread.__init__(self)
+        # Single scheduler thread for button releases and frame flushes
+        scheduler = releasescheduler()
+        scheduler.start()
+        controllercore.__init__(self, buttons, cmds, frame_time,
+                                backend, queue_size, queue_policy, scheduler, threading.Lock(),
+                                max_programs, priority_burst)
+
+        self.condition = threading.Condition()
+        self.status = EXEC_UNTIL_EMPTY
+
+
+    def run(self):
+        """Main loop"""
+
+        execute = 0
+        while(True):
+            # Check status and if necessary wait for commands from queue
+            with self.condition:
+                if self.status == READY:
+                    self.status = EXEC_UNTIL_EMPTY
+                    execute = 1
+                else:
+                    self.condition.wait()
+
+            # If execute is set, there should be data. Check and execute
+            if execute:
+                execute = 0
+                # Always ensure that queued commands are executed first.
+                while True:
+                    with self.condition:
+                        if not self.queue:
+                            break
+                        cmd = self.queue.popleft()
+                    self._button_press(cmd)
+
+
+    def queue_command(self, cmd, user = None, priority = PRIORITY_CHAT):
+        """Enter the given command to execution queue at priority.
+        If the queue is full, the command is handled according to the queue policy.
+        """
+
+        with self.condition:
+            if self._enqueue(cmd, user, priority):
+                self.status = READY
+                self.condition.notify()
+
+
+class aController(controllercore):
+    """Asyncio controller engine running on the bot's event loop.
+    Releases, frame flushes, programs and sequence steps are loop.call_at deadlines.
+    No threads or thread locks are involved, so all methods must be called from the loop.
+    """
+
+
+    def __init__(self, loop, buttons : int, cmds: commandtable, frame_time = FRAME_TIME,
+                 backend = None, queue_size = QUEUE_SIZE, queue_policy = DROP_OLDEST,
+                 max_programs = MAX_PROGRAMS, priority_burst = PRIORITY_BURST):
+        controllercore.__init__(self, buttons, cmds, frame_time,
+                                backend, queue_size, queue_policy, loopscheduler(loop),
+                                contextlib.nullcontext(), max_programs, priority_burst)
+        self.loop = loop
+        self.drain_scheduled = False
+
+
+    def start(self):
+        """Nothing to start, the loop drives everything. Kept for tController compatibility"""
+
+
+    def __drain(self):
+        """Execute all queued commands"""
+
+        self.drain_scheduled = False
+        while self.queue:
+            self._button_press(self.queue.popleft())
+
+
+    def queue_command(self, cmd, user = None, priority = PRIORITY_CHAT):
+        """Enter the given command to execution queue at priority.
+        If the queue is full, the command is handled according to the queue policy.
+        """
+
+        if self._enqueue(cmd, user, priority) and not self.drain_scheduled:
+            self.drain_scheduled = True
+            self.loop.call_soon(self.__drain)
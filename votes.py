@@ -0,0 +1,322 @@
+import math
+import random
+import sys
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class voteround:
+    """Single command vote round.
+
+    Counts are kept in a list indexed by command id and voters in a set.
+    The leader and the set of commands tied for the lead are updated as
+    votes arrive, so closing the round does not scan the tally.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = [0] * size
+        self.voters = set()
+        self.leader = None
+        self.best = 0
+        self.ties = set()
+
+
+    def vote(self, user, cid):
+        """Register user's vote for command id. Returns False if user already voted"""
+
+        if user in self.voters:
+            return False
+        self.voters.add(user)
+        count = self.counts[cid] + 1
+        self.counts[cid] = count
+        if count > self.best:
+            self.best = count
+            self.leader = cid
+            self.ties.clear()
+            self.ties.add(cid)
+        elif count == self.best:
+            self.ties.add(cid)
+        return True
+
+
+    def winner(self):
+        """Return winning command id, ties broken at random. None if there were no votes"""
+
+        if not self.best:
+            return None
+        if len(self.ties) == 1:
+            return self.leader
+        return random.choice(tuple(self.ties))
+
+
+    def reset(self):
+        """Clear the round for reuse"""
+
+        self.counts = [0] * self.size
+        self.voters.clear()
+        self.leader = None
+        self.best = 0
+        self.ties.clear()
+
+
+    def resize(self, size):
+        """Grow the tally to size commands, keeping the votes"""
+
+        if size > self.size:
+            self.counts.extend([0] * (size - self.size))
+            self.size = size
+
+
+    def __len__(self):
+        return len(self.voters)
+
+
+class planround:
+    """Communist plan vote round.
+
+    Votes are kept in a plan_size x commands integer matrix. A ballot is
+    applied with one indexed increment and all slot winners are resolved
+    with one vectorized argmax, ties broken at random.
+    """
+
+    def __init__(self, plan_size, size, rng = None):
+        self.plan_size = plan_size
+        self.size = size
+        self.counts = np.zeros((plan_size, size), dtype = np.int32)
+        self.slots = np.arange(plan_size)
+        self.voters = set()
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+
+    def vote(self, user, plan):
+        """Register user's plan (command id per slot). Returns False if user already voted"""
+
+        if user in self.voters:
+            return False
+        self.voters.add(user)
+        self.counts[self.slots, plan] += 1
+        return True
+
+
+    def winners(self):
+        """Return the winning command id of each slot. None if there were no votes"""
+
+        if not self.voters:
+            return None
+        best = self.counts.max(axis = 1, keepdims = True)
+        # Random key for each tied maximum, -1 for everything else
+        keys = np.where(self.counts == best, self.rng.random(self.counts.shape), -1.0)
+        return keys.argmax(axis = 1).tolist()
+
+
+    def reset(self):
+        """Clear the round for reuse"""
+
+        self.counts.fill(0)
+        self.voters.clear()
+
+
+    def resize(self, size):
+        """Grow the tally to size commands, keeping the votes"""
+
+        if size > self.size:
+            grown = np.zeros((self.plan_size, size), dtype = np.int32)
+            grown[:, :self.size] = self.counts
+            self.counts = grown
+            self.size = size
+
+
+    def __len__(self):
+        return len(self.voters)
+
+
+# Rebase decayed counts once vote weights grow past this
+MAX_WEIGHT = 1e12
+
+
+class decayround:
+    """Exponentially time-decayed command votes for live democracy.
+
+    Instead of decaying every count as time passes, each new vote is added
+    with a weight that grows as 2^(t / halflife). Decay then never changes
+    the order of the counts, so a vote and the leader update are O(1).
+    Actual decayed counts are the stored counts divided by the current
+    weight. Counts are rebased when the weight grows too large.
+    """
+
+    def __init__(self, size, halflife, now = None):
+        self.size = size
+        self.rate = math.log(2) / halflife
+        self.origin = time.monotonic() if now is None else now
+        self.counts = [0.0] * size
+        self.total = 0.0
+        self.leader = None
+        self.votes = 0
+
+
+    def __weight(self, now):
+        weight = math.exp(self.rate * (now - self.origin))
+        if weight > MAX_WEIGHT:
+            self.counts = [count / weight for count in self.counts]
+            self.total /= weight
+            self.origin = now
+            weight = 1.0
+        return weight
+
+
+    def vote(self, cid, now = None):
+        """Add a vote for command id"""
+
+        weight = self.__weight(time.monotonic() if now is None else now)
+        count = self.counts[cid] + weight
+        self.counts[cid] = count
+        self.total += weight
+        self.votes += 1
+        if self.leader is None or count > self.counts[self.leader]:
+            self.leader = cid
+
+
+    def leading(self, now = None):
+        """Return leading command id, its decayed vote count and share of all
+        decayed votes. None if there are no votes.
+        """
+
+        if self.leader is None:
+            return None
+        weight = self.__weight(time.monotonic() if now is None else now)
+        count = self.counts[self.leader]
+        return self.leader, count / weight, count / self.total
+
+
+    def spend(self, cid):
+        """Remove the votes of an executed command"""
+
+        self.total = max(0.0, self.total - self.counts[cid])
+        self.counts[cid] = 0.0
+        if self.total > 0:
+            self.leader = max(range(self.size), key = self.counts.__getitem__)
+        else:
+            self.total = 0.0
+            self.leader = None
+
+
+    def resize(self, size):
+        """Grow the tally to size commands, keeping the votes"""
+
+        if size > self.size:
+            self.counts.extend([0.0] * (size - self.size))
+            self.size = size
+
+
+    def reset(self):
+        self.counts = [0.0] * self.size
+        self.total = 0.0
+        self.leader = None
+        self.votes = 0
+
+
+    def __len__(self):
+        return self.votes
+
+
+# Default seconds without activity before a mode voter is expired, 0 keeps everyone
+VOTER_IDLE = 3600.0
+
+
+class voterregistry:
+    """Mode votes of the users in chat.
+
+    User names are interned, and the number of users per mode value is kept
+    up to date on every join, vote and part, so counting never scans the
+    users. Users are kept in order of last activity, so expiring the idle
+    ones only looks at the front.
+    """
+
+    def __init__(self, slots, idle = VOTER_IDLE):
+        self.counts = [0] * slots
+        self.idle = idle
+        # user -> [mode value, last activity], least recently active first
+        self.voters = OrderedDict()
+
+
+    def join(self, user, value, now = None):
+        """Add user with value, or mark an existing user active. Returns True if added"""
+
+        entry = self.voters.get(user)
+        if entry is not None:
+            entry[1] = time.monotonic() if now is None else now
+            self.voters.move_to_end(user)
+            return False
+        self.voters[sys.intern(user)] = [value, time.monotonic() if now is None else now]
+        self.counts[value] += 1
+        return True
+
+
+    def set(self, user, value, now = None):
+        """Set the mode value of user, adding them if needed"""
+
+        if not self.join(user, value, now):
+            entry = self.voters[user]
+            self.counts[entry[0]] -= 1
+            self.counts[value] += 1
+            entry[0] = value
+
+
+    def touch(self, user, now = None):
+        """Mark user active if registered"""
+
+        entry = self.voters.get(user)
+        if entry is not None:
+            entry[1] = time.monotonic() if now is None else now
+            self.voters.move_to_end(user)
+
+
+    def remove(self, user):
+        """Remove user. Returns False if they were not registered"""
+
+        entry = self.voters.pop(user, None)
+        if entry is None:
+            return False
+        self.counts[entry[0]] -= 1
+        return True
+
+
+    def expire(self, now = None):
+        """Remove users idle for longer than idle seconds and return their names"""
+
+        expired = []
+        if not self.idle:
+            return expired
+        limit = (time.monotonic() if now is None else now) - self.idle
+        while self.voters:
+            user, entry = next(iter(self.voters.items()))
+            if entry[1] > limit:
+                break
+            self.voters.popitem(last = False)
+            self.counts[entry[0]] -= 1
+            expired.append(user)
+        return expired
+
+
+    def load(self, voters, now = None):
+        """Replace all users with the user -> mode value dict voters"""
+
+        self.voters.clear()
+        self.counts = [0] * len(self.counts)
+        for user, value in voters.items():
+            self.join(user, value, now)
+
+
+    def get(self, user, default = None):
+        entry = self.voters.get(user)
+        return default if entry is None else entry[0]
+
+
+    def __contains__(self, user):
+        return user in self.voters
+
+
+    def __len__(self):
+        return len(self.voters)